@@ -0,0 +1,69 @@
+"""
+Compare the ways of assigning ownership of a narrative tree in create_volume:
+
+  walk     - write all the files, then os.chown every entry from os.walk
+             (what create_volume used to do)
+  inline   - chown each file right after it's written (_download_folder)
+  parallel - write all the files, then _chown_tree
+
+Ownership is set to the current user, so the benchmark doesn't need root.
+
+    python benchmarks/chown.py [--files 20000] [--dirs 200] [--workers 8]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from gwvolman.utils import _chown_tree
+
+
+def make_tree(root, n_files, n_dirs, chown=None):
+    for d in range(n_dirs):
+        path = os.path.join(root, 'dir%d' % d)
+        os.mkdir(path)
+        if chown:
+            chown(path)
+    for f in range(n_files):
+        path = os.path.join(root, 'dir%d' % (f % n_dirs), 'file%d' % f)
+        with open(path, 'wb') as fp:
+            fp.write(b'x')
+        if chown:
+            chown(path)
+
+
+def walk(root, uid, gid):
+    os.chown(root, uid, gid)
+    for dirpath, dirs, files in os.walk(root):
+        for obj in dirs + files:
+            os.chown(os.path.join(dirpath, obj), uid, gid)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--dirs', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+    uid, gid = os.getuid(), os.getgid()
+
+    def run(name, func):
+        root = tempfile.mkdtemp()
+        try:
+            tic = time.time()
+            func(root)
+            print('{:10s} {:8.3f}s'.format(name, time.time() - tic))
+        finally:
+            shutil.rmtree(root)
+
+    run('walk', lambda root: (make_tree(root, args.files, args.dirs),
+                              walk(root, uid, gid)))
+    run('inline', lambda root: make_tree(
+        root, args.files, args.dirs, lambda path: os.lchown(path, uid, gid)))
+    run('parallel', lambda root: (make_tree(root, args.files, args.dirs),
+                                  _chown_tree(root, uid, gid, args.workers)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,31 @@
 """WholeTale Girder Worker Plugin."""
 from girder_worker import GirderWorkerPluginABC
+from celery.signals import celeryd_after_setup, worker_ready
 from kombu.common import Broadcast, Exchange, Queue
 
 
+def _route_task(name, args, kwargs, options, task=None, **kw):
+    from .placement import route_task
+    return route_task(name, args, kwargs, options, task=task, **kw)
+
+
+@celeryd_after_setup.connect
+def _add_node_queue(sender, instance, **kwargs):
+    """Consume the queue of the node this worker runs on."""
+    from .placement import local_node_id, node_queue
+    instance.app.amqp.queues.select_add(node_queue(local_node_id()))
+
+
+@worker_ready.connect
+def _on_worker_ready(sender, **kwargs):
+    from .placement import start_node_reports
+    from .pool import VOLUME_POOL
+    from .utils import _get_docker_client
+    start_node_reports()
+    # Fill the pool up front rather than on the first launch
+    VOLUME_POOL.refill_async(_get_docker_client())
+
+
 class GWVolumeManagerPlugin(GirderWorkerPluginABC):
     """Custom WT Manager providing WT tasks."""
 
@@ -17,9 +40,13 @@ class GWVolumeManagerPlugin(GirderWorkerPluginABC):
                   routing_key='celery'),
             Broadcast('broadcast_tasks')
         )
-        self.app.conf.task_routes = {
-            'gwvolman.tasks.shutdown_container': {'queue': 'broadcast_tasks'}
-        }
+        # Instance tasks go to the queue of their node, see placement
+        self.app.conf.task_routes = (
+            _route_task,
+            {
+                'gwvolman.tasks.prefetch_images': {'queue': 'broadcast_tasks'}
+            }
+        )
         # self.app.config.update({
         #     'TASK_TIME_LIMIT': 300
         # })
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Admission control of the launches on swarm nodes."""
+
+from contextlib import contextmanager
+import logging
+import os
+import time
+import uuid
+
+import redis
+
+from .utils import _get_redis
+
+# Launches running at once on a node, 0 disables admission control
+MAX_LAUNCHES_PER_NODE = int(os.environ.get('MAX_LAUNCHES_PER_NODE', 4))
+# Past this average launch time (in seconds) the launches that would have to
+# wait are refused, 0 never refuses
+LAUNCH_LATENCY_LIMIT = float(os.environ.get('LAUNCH_LATENCY_LIMIT', 0))
+LAUNCH_QUEUE_TIMEOUT = float(os.environ.get('LAUNCH_QUEUE_TIMEOUT', 600))
+# A launch holds its slot at most this long, in case its worker died
+LAUNCH_SLOT_TTL = float(os.environ.get('LAUNCH_SLOT_TTL', 900))
+# A queued launch gives its worker back and is retried after this many seconds
+LAUNCH_RETRY_INTERVAL = float(os.environ.get('LAUNCH_RETRY_INTERVAL', 5))
+# A waiting launch that wasn't retried for this long loses its place
+WAITING_TTL = max(60.0, 6 * LAUNCH_RETRY_INTERVAL)
+LATENCY_WEIGHT = 0.2
+
+WAITING_KEY = 'gwvolman:admission:{}:waiting'
+HEARTBEAT_KEY = 'gwvolman:admission:{}:heartbeat'
+ACTIVE_KEY = 'gwvolman:admission:{}:active'
+LATENCY_KEY = 'gwvolman:admission:{}:latency:{}'
+LOCK_KEY = 'gwvolman:admission:{}:lock'
+
+
+def latency(node_id, kind):
+    """Return the moving average of the time a kind of launch takes on a node."""
+    value = _get_redis().get(LATENCY_KEY.format(node_id, kind))
+    return float(value) if value is not None else None
+
+
+def _record_latency(r, node_id, kind, seconds):
+    key = LATENCY_KEY.format(node_id, kind)
+    with r.lock(LOCK_KEY.format(node_id), timeout=10):
+        value = r.get(key)
+        if value is not None:
+            seconds = (1 - LATENCY_WEIGHT) * float(value) + \
+                LATENCY_WEIGHT * seconds
+        r.set(key, seconds)
+
+
+def _active(r, node_id):
+    """Return the live slots of a node, dropping the expired ones."""
+    key = ACTIVE_KEY.format(node_id)
+    now = time.time()
+    active = []
+    for ticket, expires in r.hgetall(key).items():
+        if float(expires) < now:
+            r.hdel(key, ticket)
+        else:
+            active.append(ticket)
+    return active
+
+
+def _waiting(r, node_id):
+    """
+    Return the tickets waiting on a node in arrival order, dropping the
+    ones that stopped being retried (revoked or lost while queued).
+    """
+    now = time.time()
+    heartbeats = r.hgetall(HEARTBEAT_KEY.format(node_id))
+    waiting = []
+    for ticket in r.lrange(WAITING_KEY.format(node_id), 0, -1):
+        heartbeat = heartbeats.get(ticket)
+        if heartbeat is None or float(heartbeat) < now - WAITING_TTL:
+            r.lrem(WAITING_KEY.format(node_id), 1, ticket)
+            r.hdel(HEARTBEAT_KEY.format(node_id), ticket)
+        else:
+            waiting.append(ticket)
+    return waiting
+
+
+def _leave_queue(r, node_id, ticket):
+    r.lrem(WAITING_KEY.format(node_id), 1, ticket)
+    r.hdel(HEARTBEAT_KEY.format(node_id), ticket)
+
+
+def _try_admit(r, node_id, ticket):
+    """
+    Give a slot to the ticket if it's among the first ones waiting for the
+    free slots of the node. Return its position in the queue otherwise,
+    queueing it if it isn't waiting yet.
+    """
+    with r.lock(LOCK_KEY.format(node_id), timeout=10):
+        r.hset(HEARTBEAT_KEY.format(node_id), ticket, time.time())
+        free = MAX_LAUNCHES_PER_NODE - len(_active(r, node_id))
+        waiting = _waiting(r, node_id)
+        if ticket not in waiting:
+            r.rpush(WAITING_KEY.format(node_id), ticket)
+            waiting.append(ticket)
+        position = waiting.index(ticket)
+        if position < free:
+            _leave_queue(r, node_id, ticket)
+            r.hset(ACTIVE_KEY.format(node_id), ticket,
+                   time.time() + LAUNCH_SLOT_TTL)
+            return None
+        return position - max(free, 0) + 1
+
+
+@contextmanager
+def admit(task, payload, node_id, kind, progress=None):
+    """
+    Hold a launch slot of a node. While all the slots are taken the task
+    keeps its place in the queue of the node and is retried later, so that
+    queued launches don't tie up the workers of the node.
+
+    :param task: The bound task doing the launch
+    :param payload: The payload of the task, which carries the queue ticket
+        across the retries
+    :param node_id: The swarm id of the node
+    :param kind: The kind of launch, the latency of each kind is tracked
+        separately
+    :param progress: Called with the position in the queue and an estimated
+        wait in seconds (None until a launch has finished) while waiting
+    :raises RuntimeError: when the node is overloaded or the wait timed out
+    :raises celery.exceptions.Retry: when the task has to wait for a slot
+    """
+    if MAX_LAUNCHES_PER_NODE <= 0:
+        yield
+        return
+    r = _get_redis()
+    queued = payload.pop('admission', None) or \
+        {'ticket': uuid.uuid4().hex, 'since': time.time()}
+    ticket = queued['ticket'].encode('utf8')
+
+    position = _try_admit(r, node_id, ticket)
+    if position is not None:
+        average = latency(node_id, kind)
+        if LAUNCH_LATENCY_LIMIT and average is not None and \
+                average > LAUNCH_LATENCY_LIMIT:
+            _leave_queue(r, node_id, ticket)
+            raise RuntimeError(
+                'Node {} is overloaded: launches take {:.1f}s, refusing '
+                'to queue more'.format(node_id, average))
+        if time.time() - queued['since'] > LAUNCH_QUEUE_TIMEOUT:
+            _leave_queue(r, node_id, ticket)
+            raise RuntimeError(
+                'Timed out after {:.0f}s waiting to launch on node '
+                '{}'.format(LAUNCH_QUEUE_TIMEOUT, node_id))
+        if progress is not None:
+            eta = None
+            if average is not None:
+                rounds = (position - 1) // MAX_LAUNCHES_PER_NODE + 1
+                eta = rounds * average
+            progress(position, eta)
+        payload['admission'] = queued
+        raise task.retry(args=(payload,), countdown=LAUNCH_RETRY_INTERVAL,
+                         max_retries=None)
+
+    tic = time.time()
+    try:
+        yield
+    finally:
+        try:
+            r.hdel(ACTIVE_KEY.format(node_id), ticket)
+            _record_latency(r, node_id, kind, time.time() - tic)
+        except redis.RedisError as e:
+            logging.warning('Unable to release the launch slot: %s', e)
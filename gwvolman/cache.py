@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""Node-local caches used by the WT tasks."""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from urllib.request import urlopen
+
+CACHE_DIR = os.environ.get('CACHE_DIR',
+                           os.path.join(tempfile.gettempdir(), 'gwvolman'))
+MD5_CACHE_ENTRIES = int(os.environ.get('MD5_CACHE_ENTRIES', 100000))
+ENVIRONMENT_CACHE_SIZE = int(os.environ.get('ENVIRONMENT_CACHE_SIZE',
+                                            5 * 1024 ** 3))
+
+# Node-local copies of narrative folders, disabled unless a directory is set.
+# It should live on the same filesystem as the docker volumes for reflinks.
+NARRATIVE_CACHE_DIR = os.environ.get('NARRATIVE_CACHE_DIR')
+NARRATIVE_CACHE_SIZE = int(os.environ.get('NARRATIVE_CACHE_SIZE',
+                                          10 * 1024 ** 3))
+
+CachedTarball = namedtuple('CachedTarball', ['path', 'md5', 'size'])
+
+
+class ChecksumCache(object):
+    """
+    A persistent store of md5 checksums of Girder files.
+
+    Entries are keyed by the file `_id` and are only valid as long as the
+    size and modification time of the file match the ones that were hashed.
+    The least recently used entries are evicted once the store holds more
+    than `max_entries` checksums.
+    """
+
+    def __init__(self, path, max_entries=MD5_CACHE_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        if not self._initialized:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS checksums ('
+                    'file_id TEXT PRIMARY KEY, size INTEGER, modified TEXT, '
+                    'md5 TEXT, accessed REAL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS checksums_accessed '
+                             'ON checksums (accessed)')
+            self._initialized = True
+        return conn
+
+    @staticmethod
+    def _identity(file_object):
+        modified = file_object.get('updated', file_object.get('created'))
+        return str(file_object['_id']), file_object.get('size'), str(modified)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, file_object):
+        """
+        Look up the checksum of a Girder file.
+
+        :param file_object: The Girder file
+        :type file_object: girder.models.file
+        :return: The md5 hex digest or None if it isn't known
+        :rtype: str
+        """
+        file_id, size, modified = self._identity(file_object)
+        try:
+            conn = self._connect()
+            with conn:
+                row = conn.execute(
+                    'SELECT md5 FROM checksums WHERE file_id = ? AND size = ? '
+                    'AND modified = ?', (file_id, size, modified)).fetchone()
+                if row is not None:
+                    conn.execute('UPDATE checksums SET accessed = ? '
+                                 'WHERE file_id = ?', (time.time(), file_id))
+            conn.close()
+        except sqlite3.Error as e:
+            logging.warning('Checksum cache lookup failed: %s', e)
+            row = None
+        self._count(row is not None)
+        return row[0] if row is not None else None
+
+    def put(self, file_object, md5):
+        """
+        Store the checksum of a Girder file.
+
+        :param file_object: The Girder file that was hashed
+        :param md5: The md5 hex digest of the file
+        :type file_object: girder.models.file
+        :type md5: str
+        """
+        file_id, size, modified = self._identity(file_object)
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO checksums '
+                    '(file_id, size, modified, md5, accessed) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (file_id, size, modified, md5, time.time()))
+                excess = conn.execute(
+                    'SELECT COUNT(*) FROM checksums').fetchone()[0] - \
+                    self.max_entries
+                if excess > 0:
+                    conn.execute(
+                        'DELETE FROM checksums WHERE file_id IN ('
+                        'SELECT file_id FROM checksums '
+                        'ORDER BY accessed ASC LIMIT ?)', (excess,))
+            conn.close()
+        except sqlite3.Error as e:
+            logging.warning('Checksum cache update failed: %s', e)
+
+    def stats(self):
+        """Return the hit and miss counters of this process."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class TarballCache(object):
+    """
+    A content-addressed store of environment tarballs.
+
+    Recipe commits are immutable, so a tarball is keyed by the recipe url and
+    its commit id and never has to be revalidated. Each tarball is stored next
+    to a small JSON document holding its md5 and size, whose modification time
+    records when the tarball was last used. Least recently used tarballs are
+    evicted once the store grows past `max_size` bytes.
+    """
+
+    def __init__(self, root, max_size=ENVIRONMENT_CACHE_SIZE):
+        self.root = root
+        self.max_size = max_size
+
+    def _paths(self, url, commit_id):
+        key = hashlib.sha1(
+            '{}@{}'.format(url, commit_id).encode('utf-8')).hexdigest()
+        base = os.path.join(self.root, key)
+        return base + '.tar.gz', base + '.json'
+
+    def get(self, url, commit_id):
+        """
+        Look up a tarball.
+
+        :param url: The url of the recipe repository
+        :param commit_id: The commit of the recipe
+        :type url: str
+        :type commit_id: str
+        :return: The cached tarball or None
+        :rtype: CachedTarball
+        """
+        tarball, meta = self._paths(url, commit_id)
+        try:
+            with open(meta) as fp:
+                info = json.load(fp)
+            if os.path.getsize(tarball) != info['size']:
+                return None
+            os.utime(meta, None)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        return CachedTarball(path=tarball, md5=info['md5'], size=info['size'])
+
+    def fetch(self, url, commit_id):
+        """
+        Return a tarball from the cache, downloading it on a miss. The md5 is
+        computed while the tarball is written to disk.
+
+        :param url: The url of the recipe repository
+        :param commit_id: The commit of the recipe
+        :type url: str
+        :type commit_id: str
+        :return: The cached tarball
+        :rtype: CachedTarball
+        """
+        cached = self.get(url, commit_id)
+        if cached is not None:
+            logging.debug('Environment tarball cache hit for %s@%s',
+                          url, commit_id)
+            return cached
+
+        try:
+            os.makedirs(self.root)
+        except OSError:
+            pass  # already exists
+        tarball, meta = self._paths(url, commit_id)
+        partial = '{}.{}.part'.format(tarball, uuid.uuid4().hex)
+        md5 = hashlib.md5()
+        size = 0
+        try:
+            src = urlopen(url + '/tarball/' + commit_id)
+            with open(partial, 'wb') as fp:
+                for chunk in iter(lambda: src.read(8192), b''):
+                    md5.update(chunk)
+                    fp.write(chunk)
+                    size += len(chunk)
+            os.rename(partial, tarball)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        partial = '{}.{}.part'.format(meta, uuid.uuid4().hex)
+        with open(partial, 'w') as fp:
+            json.dump({'md5': md5.hexdigest(), 'size': size,
+                       'url': url, 'commitId': commit_id}, fp)
+        os.rename(partial, meta)
+        self.evict(keep=tarball)
+        return CachedTarball(path=tarball, md5=md5.hexdigest(), size=size)
+
+    def evict(self, keep=None):
+        """Remove least recently used tarballs until the cache fits its budget."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            if not name.endswith('.json'):
+                continue
+            meta = os.path.join(self.root, name)
+            tarball = meta[:-len('.json')] + '.tar.gz'
+            try:
+                size = os.path.getsize(tarball)
+                entries.append((os.path.getmtime(meta), tarball, meta, size))
+            except OSError:
+                continue
+            total += size
+        for _, tarball, meta, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            if tarball == keep:
+                continue
+            logging.info('Evicting environment tarball %s', tarball)
+            for path in (meta, tarball):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+
+class NarrativeCache(object):
+    """
+    A node-local store of narrative folders used to populate new volumes.
+
+    Each entry holds a copy of a Girder folder tree and a manifest recording,
+    for every file, the Girder file id, size and the `updated` time of its
+    item. Entries are synced against a fresh listing made with the launching
+    user's client, so access is still checked by Girder and only files that
+    changed are downloaded. Volumes are populated with `cp --reflink=auto`,
+    which shares blocks copy-on-write where the filesystem supports it; hard
+    links are not used, as edits in an instance would leak back into the
+    cache. Least recently used entries are evicted past `max_size` bytes.
+    """
+
+    def __init__(self, root, max_size=NARRATIVE_CACHE_SIZE, workers=8):
+        self.root = root
+        self.max_size = max_size
+        self.workers = workers
+
+    @property
+    def enabled(self):
+        return bool(self.root)
+
+    def _entry(self, folder_id):
+        base = os.path.join(self.root, str(folder_id))
+        return base, os.path.join(base, 'tree'), base + '.manifest', \
+            base + '.lock'
+
+    def folders(self):
+        """Return the ids of the folders held in the cache."""
+        if not self.enabled or not os.path.isdir(self.root):
+            return []
+        return [name[:-len('.manifest')] for name in os.listdir(self.root)
+                if name.endswith('.manifest')]
+
+    @staticmethod
+    def _load_manifest(path):
+        try:
+            with open(path) as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {'files': {}, 'size': 0}
+
+    def sync(self, gc, folder_id, uid=None, gid=None, dest=None):
+        """
+        Bring the cached copy of a folder up to date, then copy it into dest
+        if given.
+
+        The copy is made under the same exclusive lock as the sync, so the
+        tree copied is exactly the one listed with the user's client: another
+        user's sync can't swap in files this user can't read in between.
+
+        :param gc: The girder client of the user launching the tale
+        :param folder_id: The id of the narrative folder
+        :param uid: The owner of the cached files
+        :param gid: The group of the cached files
+        :param dest: The directory the tree is copied into
+        :return: The number of files and bytes that had to be downloaded
+        :rtype: dict
+        """
+        from .utils import _list_folder, _item_targets, _download_file
+
+        def chown(path):
+            if uid is not None:
+                os.lchown(path, uid, gid)
+
+        base, tree, manifest_path, lock_path = self._entry(folder_id)
+        try:
+            os.makedirs(tree)
+        except OSError:
+            pass  # already exists
+
+        with open(lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = self._load_manifest(manifest_path)
+            dirs, items = _list_folder(gc, folder_id, tree)
+
+            def list_item(job):
+                item, dest = job
+                item_dir, targets = _item_targets(gc, item, dest)
+                return item, item_dir, targets
+
+            wanted = dict()
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for item, item_dir, targets in executor.map(list_item, items):
+                    if item_dir is not None:
+                        dirs.append(item_dir)
+                    for file, path in targets:
+                        wanted[os.path.relpath(path, tree)] = \
+                            [str(file['_id']), file.get('size', 0),
+                             str(item.get('updated'))]
+
+            # Remove what is gone from Girder, then fetch what changed
+            for rel in set(manifest['files']) - set(wanted):
+                try:
+                    os.remove(os.path.join(tree, rel))
+                except OSError:
+                    pass
+            for dirpath, _, _ in list(os.walk(tree, topdown=False)):
+                if dirpath != tree and dirpath not in dirs:
+                    shutil.rmtree(dirpath, ignore_errors=True)
+            for path in dirs:
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                    chown(path)
+            stale = [(rel, ident) for rel, ident in wanted.items()
+                     if manifest['files'].get(rel) != ident]
+
+            def fetch(job):
+                rel, ident = job
+                path = os.path.join(tree, rel)
+                _download_file(gc, ident[0], path)
+                chown(path)
+                return ident[1]
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                fetched = sum(executor.map(fetch, stale))
+
+            manifest = {'folderId': str(folder_id), 'files': wanted,
+                        'size': sum(ident[1] for ident in wanted.values())}
+            with open(manifest_path + '.part', 'w') as fp:
+                json.dump(manifest, fp)
+            os.rename(manifest_path + '.part', manifest_path)
+
+            if dest is not None:
+                subprocess.check_call(
+                    ['cp', '-a', '--reflink=auto', tree + '/.', dest])
+
+        logging.info('Narrative cache sync of %s: %d of %d files fetched',
+                     folder_id, len(stale), len(wanted))
+        self.evict(keep=str(folder_id))
+        return {'files': len(stale), 'bytes': fetched}
+
+    def populate(self, gc, folder_id, dest, uid=None, gid=None):
+        """
+        Sync the cached copy of a folder and copy it into dest, preserving
+        ownership.
+        """
+        return self.sync(gc, folder_id, uid, gid, dest=dest)
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits its budget."""
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith('.manifest'):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            entries.append((mtime, name[:-len('.manifest')],
+                            self._load_manifest(path)['size']))
+        total = sum(size for _, _, size in entries)
+        for _, folder_id, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            if folder_id == keep:
+                continue
+            base, tree, manifest_path, lock_path = self._entry(folder_id)
+            with open(lock_path, 'w') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    continue  # being synced or cloned
+                logging.info('Evicting narrative %s from the cache', folder_id)
+                os.remove(manifest_path)
+                shutil.rmtree(base, ignore_errors=True)
+            total -= size
+
+
+MD5_CACHE = ChecksumCache(os.path.join(CACHE_DIR, 'checksums.db'))
+ENVIRONMENT_CACHE = TarballCache(os.path.join(CACHE_DIR, 'environments'))
+NARRATIVE_CACHE = NarrativeCache(NARRATIVE_CACHE_DIR)
@@ -7,6 +7,8 @@ from girder import events
 API_VERSION = '2.0'
 GIRDER_API_URL = os.environ.get(
     "GIRDER_API_URL", "https://girder.wholetale.org/api/v1")
+# Upper bound on concurrent uploads from a worker to a single DataONE member node
+DATAONE_MAX_CONCURRENCY = int(os.environ.get("DATAONE_MAX_CONCURRENCY", 4))
 
 
 class DataONELocations:
@@ -12,8 +12,8 @@ from .utils import \
     strip_html_tags, \
     check_pid, \
     get_directory, \
-    get_file_item, \
-    compute_md5
+    compute_md5, \
+    ItemMetadataCache
 
 
 from d1_common.types import dataoneTypes
@@ -178,7 +178,8 @@ def create_minimum_eml(tale,
                        file_sizes,
                        license_id,
                        user_id,
-                       gc):
+                       gc,
+                       cache=None):
     """
     Creates a bare minimum EML record for a package. Note that the
     ordering of the xml elements matters.
@@ -193,6 +194,7 @@ def create_minimum_eml(tale,
     :param user_id: The user's user id from the JWT
     girder items/files
     :param gc: The girder client
+    :param cache: The metadata cache of the job
     :type tale: wholetale.models.tale
     :type user: girder.models.user
     :type item_ids: list
@@ -200,6 +202,7 @@ def create_minimum_eml(tale,
     :type file_sizes: dict
     :type license_id: str
     :type user_id: str
+    :type cache: ItemMetadataCache
     :return: The EML as as string of bytes
     :rtype: bytes
     """
@@ -259,11 +262,13 @@ def create_minimum_eml(tale,
     set_user_contact(contact, user_id, email)
 
     # Add a <otherEntity> block for each object
+    if cache is None:
+        cache = ItemMetadataCache(gc)
     for item_id in item_ids:
 
         # Create the record for the object
-        item = gc.getItem(item_id)
-        file = get_file_item(item_id, gc)
+        item = cache.get_item(item_id)
+        file = cache.get_file(item_id)
         add_object_record(dataset,
                           item['name'],
                           item.get('description', ''),
@@ -328,9 +333,11 @@ def generate_system_metadata(pid,
                              name,
                              rights_holder,
                              is_file=False,
-                             size=None):
+                             size=None,
+                             md5=None):
     """
-    Generates a metadata document describing the file_object.
+    Generates a metadata document describing the file_object. If the md5 of
+    the object is already known, pass it in to avoid reading the object again.
 
     :param pid: The pid that the object will have
     :param format_id: The format of the object (e.g text/csv)
@@ -339,6 +346,7 @@ def generate_system_metadata(pid,
     :param rights_holder: The owner of this object
     :param is_file: A bool set to true if file_object is an iterator
     :param size: The size of the file
+    :param md5: The hex digest of the object, if it has already been computed
     :type pid: str
     :type format_id: str
     :type file_object: unicode or girder.models.file
@@ -346,22 +354,23 @@ def generate_system_metadata(pid,
     :type rights_holder: str
     :type is_file: Bool
     :type size: int
+    :type md5: str
     :return: The metadata describing file_object
     :rtype: d1_common.types.generated.dataoneTypes_v2_0.SystemMetadata
     """
 
-    md5 = hashlib.md5()
-    if is_file:
-        # If it's a local file, get the md5 of it
-        md5 = compute_md5(file_object)
-    else:
-        # Check that the file_object is unicode, attempt to convert it if it's a str
-        if not isinstance(file_object, bytes):
-            if isinstance(file_object, str):
-                file_object = file_object.encode("utf-8")
-        md5.update(file_object)
-        size = len(file_object)
-    md5 = md5.hexdigest()
+    if md5 is None:
+        if is_file:
+            # If it's a local file, get the md5 of it
+            md5 = compute_md5(file_object)
+        else:
+            # Check that the file_object is unicode, attempt to convert it if it's a str
+            if not isinstance(file_object, bytes):
+                if isinstance(file_object, str):
+                    file_object = file_object.encode("utf-8")
+            md5 = hashlib.md5(file_object)
+            size = len(file_object)
+        md5 = md5.hexdigest()
     sys_meta = populate_sys_meta(pid,
                                  format_id,
                                  size,
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Tale image cache management on swarm nodes."""
+
+import logging
+import os
+import time
+
+import docker
+import redis
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+from .utils import REGISTRY_URL, _get_redis, _with_registry_auth
+
+IMAGE_CACHE_SIZE = int(os.environ.get('IMAGE_CACHE_SIZE', 50 * 1024 ** 3))
+IMAGE_PREFETCH_COUNT = int(os.environ.get('IMAGE_PREFETCH_COUNT', 10))
+
+LAUNCHES_KEY = 'gwvolman:images:launches'
+COLD_KEY = 'gwvolman:images:cold'
+LAST_USE_KEY = 'gwvolman:images:lastuse:{}'
+
+
+def _tale_image(tag):
+    return tag.startswith(urlparse(REGISTRY_URL).netloc + '/')
+
+
+def _untagged(tag):
+    name, _, suffix = tag.rpartition(':')
+    return name if name and '/' not in suffix else tag
+
+
+def is_cached(cli, image):
+    """Check whether an image is present on this node."""
+    try:
+        cli.images.get(image)
+        return True
+    except docker.errors.ImageNotFound:
+        return False
+
+
+def cached_images(cli):
+    """Return the names of the tale images present on this node."""
+    return sorted({_untagged(tag) for image in cli.images.list()
+                   for tag in image.tags if _tale_image(tag)})
+
+
+def pull(cli, image):
+    """Pull an image from the registry, returning how long it took."""
+    tic = time.time()
+    _with_registry_auth(cli, cli.images.pull, image)
+    return time.time() - tic
+
+
+def record_launch(image, node_id, cold):
+    """Add a launch of image on a node to the launch history."""
+    try:
+        r = _get_redis()
+        pipe = r.pipeline()
+        pipe.zincrby(LAUNCHES_KEY, amount=1, value=image)
+        pipe.hset(LAST_USE_KEY.format(node_id), image, time.time())
+        if cold:
+            pipe.zincrby(COLD_KEY, amount=1, value=image)
+        pipe.execute()
+    except redis.RedisError as e:
+        logging.warning('Unable to record launch of %s: %s', image, e)
+
+
+def cold_launches(count=IMAGE_PREFETCH_COUNT):
+    """Return the images that most often had to be pulled during a launch."""
+    return [(image.decode('utf-8'), int(launches)) for image, launches in
+            _get_redis().zrevrange(COLD_KEY, 0, count - 1, withscores=True)]
+
+
+def prefetch(cli, count=IMAGE_PREFETCH_COUNT, images=None):
+    """
+    Pull the most launched images that are missing on this node.
+
+    :param cli: The docker client
+    :param count: How many of the most launched images to keep on the node
+    :param images: Pull these images instead of the most launched ones
+    :return: The images that were pulled
+    :rtype: list
+    """
+    if images is None:
+        images = [image.decode('utf-8') for image in
+                  _get_redis().zrevrange(LAUNCHES_KEY, 0, count - 1)]
+    pulled = []
+    for image in images:
+        if is_cached(cli, image):
+            continue
+        try:
+            logging.info('Prefetched %s in %.1fs', image, pull(cli, image))
+            pulled.append(image)
+        except docker.errors.APIError as e:
+            logging.warning('Unable to prefetch %s: %s', image, e)
+    return pulled
+
+
+def evict(cli, node_id, max_size=IMAGE_CACHE_SIZE, keep=()):
+    """
+    Remove the least recently launched tale images from this node until the
+    tale images fit in max_size bytes. Images used by a container are kept.
+
+    :return: The images that were removed
+    :rtype: list
+    """
+    try:
+        last_use = _get_redis().hgetall(LAST_USE_KEY.format(node_id))
+    except redis.RedisError as e:
+        logging.warning('Unable to read the image launch history: %s', e)
+        return []
+    last_use = {k.decode('utf-8'): float(v) for k, v in last_use.items()}
+    in_use = {c.attrs['Image'] for c in cli.containers.list(all=True)}
+
+    candidates = []
+    total = 0
+    for image in cli.images.list():
+        tags = [_untagged(tag) for tag in image.tags if _tale_image(tag)]
+        if not tags:
+            continue
+        size = image.attrs['Size']
+        total += size
+        if image.id in in_use or set(tags) & set(keep):
+            continue
+        candidates.append((max(last_use.get(tag, 0) for tag in tags),
+                           image, tags, size))
+
+    removed = []
+    for _, image, tags, size in sorted(candidates, key=lambda c: c[0]):
+        if total <= max_size:
+            break
+        try:
+            cli.images.remove(image.id, force=False)
+        except docker.errors.APIError as e:
+            logging.warning('Unable to evict %s: %s', tags, e)
+            continue
+        logging.info('Evicted %s from node %s', tags, node_id)
+        total -= size
+        removed += tags
+    return removed
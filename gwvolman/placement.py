@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""Placement of new tale instances on swarm nodes."""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from .cache import NARRATIVE_CACHE
+from .constants import GIRDER_API_URL
+from .images import cached_images
+from .pool import VOLUME_POOL
+from .utils import HOSTDIR, _get_docker_client, _get_redis, \
+    _get_girder_client, _get_container_config, _resource_spec, _node_usage, \
+    _fits, _host_meminfo
+
+NODE_REPORT_INTERVAL = int(os.environ.get('NODE_REPORT_INTERVAL', 30))
+NODE_KEY = 'gwvolman:node:{}'
+
+# Weights of the placement score, see score_node
+WEIGHTS = {
+    'memory': 1.0,
+    'cpu': 1.0,
+    'instances': 0.5,
+    'image': 0.5,
+    'narrative': 0.25
+}
+# Number of instances at which a node counts as fully loaded
+INSTANCES_PER_NODE = int(os.environ.get('INSTANCES_PER_NODE', 50))
+
+
+def node_queue(node_id):
+    """Return the name of the queue consumed by the workers of a node."""
+    return 'node.{}'.format(node_id)
+
+
+def local_node_id():
+    """Return the swarm id of the node this worker runs on."""
+    return _get_docker_client().info()['Swarm']['NodeID']
+
+
+def node_report():
+    """
+    Describe the resources and caches of this node: free memory, cpu load,
+    running instances, reserved resources, tale images that are pulled,
+    narratives that are cached and the state of the volume pool.
+    """
+    cli = _get_docker_client()
+    node_id = local_node_id()
+    meminfo = _host_meminfo()
+    with open(HOSTDIR + '/proc/loadavg') as fp:
+        load = float(fp.read().split()[0])
+    instances = [
+        c for c in cli.containers.list(
+            filters={'label': 'com.docker.swarm.service.name'})
+        if c.labels['com.docker.swarm.service.name'].startswith('tmp-')]
+    report = {
+        'nodeId': node_id,
+        'memTotal': meminfo['MemTotal'],
+        'memAvailable': meminfo.get('MemAvailable', meminfo['MemFree']),
+        'load': load,
+        'cpus': os.cpu_count() or 1,
+        'instances': len(instances),
+        'images': cached_images(cli),
+        'narratives': NARRATIVE_CACHE.folders(),
+        'volumePool': VOLUME_POOL.stats(cli),
+        'updated': time.time()
+    }
+    report.update(_node_usage(cli, node_id))
+    return report
+
+
+def publish_node_report():
+    """Store the report of this node, it expires unless refreshed."""
+    report = node_report()
+    _get_redis().setex(NODE_KEY.format(report['nodeId']),
+                       3 * NODE_REPORT_INTERVAL, json.dumps(report))
+    return report
+
+
+def _report_loop():
+    while True:
+        try:
+            publish_node_report()
+        except Exception as e:
+            logging.warning('Unable to publish the node report: %s', e)
+        time.sleep(NODE_REPORT_INTERVAL)
+
+
+def start_node_reports():
+    """Publish the node report periodically from a background thread."""
+    thread = threading.Thread(target=_report_loop, name='node-report')
+    thread.daemon = True
+    thread.start()
+
+
+def node_reports():
+    """Return the reports of all the live nodes."""
+    r = _get_redis()
+    keys = list(r.scan_iter(NODE_KEY.format('*')))
+    return [json.loads(value) for value in r.mget(keys) if value] \
+        if keys else []
+
+
+def score_node(report, image=None, narrative_id=None):
+    """
+    Score a node for a new instance, higher is better. Free memory and idle
+    cpu count the most, running instances count against the node, and an
+    already pulled image or cached narrative add a bonus.
+    """
+    memory = float(report['memAvailable']) / max(report['memTotal'], 1)
+    cpu = 1.0 - min(report['load'] / max(report['cpus'], 1), 1.0)
+    instances = min(float(report['instances']) / INSTANCES_PER_NODE, 1.0)
+    score = WEIGHTS['memory'] * memory + WEIGHTS['cpu'] * cpu - \
+        WEIGHTS['instances'] * instances
+    if image and image in report['images']:
+        score += WEIGHTS['image']
+    if narrative_id and str(narrative_id) in report['narratives']:
+        score += WEIGHTS['narrative']
+    return score
+
+
+def select_node(image=None, narrative_id=None, spec=None):
+    """
+    Return the id of the best node for a new instance or None if no node
+    has reported or has room for its resource spec.
+    """
+    reports = [report for report in node_reports()
+               if _fits(report, spec or {})]
+    if not reports:
+        return None
+    best = max(reports, key=lambda report: score_node(
+        report, image, narrative_id))
+    return best['nodeId']
+
+
+# Tasks that have to run on the node hosting the instance
+NODE_TASKS = (
+    'gwvolman.tasks.launch_container',
+    'gwvolman.tasks.remove_volume',
+    'gwvolman.tasks.shutdown_container'
+)
+
+
+def _girder_client(payload):
+    return _get_girder_client(payload.get('apiUrl', GIRDER_API_URL),
+                              payload['girder_token'])
+
+
+def _place_volume(payload):
+    gc = _girder_client(payload)
+    tale = gc.get('/tale/%s' % payload['taleId'])
+    container_config = _get_container_config(gc, tale)
+    node_id = select_node(container_config.image, tale.get('narrativeId'),
+                          _resource_spec(container_config))
+    if node_id is not None:
+        logging.info('Placing tale %s on node %s', payload['taleId'], node_id)
+    return node_id
+
+
+def _instance_node(payload):
+    # launch_container gets the nodeId set by create_volume, the other
+    # tasks only know the instance
+    if payload.get('nodeId'):
+        return payload['nodeId']
+    instance = _girder_client(payload).get(
+        '/instance/%s' % payload['instanceId'])
+    return instance.get('containerInfo', {}).get('nodeId')
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """
+    Celery router sending new instances to the queue of the best node and
+    the tasks of an existing instance to the queue of its node.
+    Any failure falls back to the default routing.
+    """
+    if not args:
+        return None
+    try:
+        if name in ('gwvolman.tasks.create_volume',
+                    'gwvolman.tasks.launch_tale'):
+            node_id = _place_volume(args[0])
+        elif name in NODE_TASKS:
+            node_id = _instance_node(args[0])
+        else:
+            return None
+    except Exception as e:
+        # Called from apply_async, a failure here must not fail the submission
+        logging.warning('Routing of %s failed, using the default queue: %s',
+                        name, e)
+        return None
+    if node_id is None:
+        return None
+    return {'queue': node_queue(node_id)}
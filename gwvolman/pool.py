@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""Warm pool of pre-provisioned tale volumes on a swarm node."""
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from docker.errors import DockerException
+import redis
+
+from .utils import HOSTDIR, PooledContainer, new_user, _safe_mkdir, \
+    _get_redis
+
+VOLUME_POOL_SIZE = int(os.environ.get('VOLUME_POOL_SIZE', 0))
+POOL_LABEL = 'wholetale.pool'
+CLAIM_MARKER = '.wt_claimed'
+# Hits and misses of the pool of a node, counted across its worker processes
+STATS_KEY = 'gwvolman:pool:{}'
+
+
+class VolumePool(object):
+    """
+    Keeps a number of empty Docker volumes with the `data`/`home` skeleton
+    ready on the node, so that launching a tale does not have to wait for
+    the volume to be created.
+
+    Pooled volumes are discovered through their label, which makes the pool
+    shared between all the worker processes on the node. A volume is claimed
+    by atomically creating a marker file at its root, so two processes can
+    never hand out the same volume.
+    """
+
+    def __init__(self, size=VOLUME_POOL_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._refill_thread = None
+        self._lock_path = os.path.join(tempfile.gettempdir(),
+                                       'gwvolman-pool.lock')
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self, cli):
+        """
+        Return the volumes available in the pool of the node and its hits
+        and misses from all the worker processes.
+        """
+        counts = _get_redis().hgetall(
+            STATS_KEY.format(cli.info()['Swarm']['NodeID']))
+        hits = int(counts.get(b'hits', 0))
+        misses = int(counts.get(b'misses', 0))
+        return {'size': self.size, 'available': len(self._available(cli)),
+                'hits': hits, 'misses': misses,
+                'hitRate': float(hits) / (hits + misses)
+                if hits + misses else 0.0}
+
+    def _pooled_volumes(self, cli):
+        return cli.volumes.list(filters={'label': POOL_LABEL})
+
+    @staticmethod
+    def _marker(mountpoint):
+        return HOSTDIR + os.path.join(mountpoint, CLAIM_MARKER)
+
+    def _available(self, cli):
+        return [vol for vol in self._pooled_volumes(cli)
+                if not os.path.exists(self._marker(vol.attrs['Mountpoint']))]
+
+    def claim(self, cli, tale_id, login):
+        """
+        Claim a pre-provisioned volume and bind it to a user and a tale.
+
+        :param cli: The docker client
+        :param tale_id: The id of the tale that is being launched
+        :param login: The login of the user launching the tale
+        :return: The claimed volume or None if the pool is empty
+        :rtype: PooledContainer
+        """
+        if self.size <= 0:
+            return None
+
+        claimed = None
+        try:
+            candidates = self._available(cli)
+        except DockerException as dex:
+            logging.warning('Unable to list pooled volumes: %s', dex)
+            candidates = []
+
+        for volume in candidates:
+            mountpoint = volume.attrs['Mountpoint']
+            try:
+                fd = os.open(self._marker(mountpoint),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                continue  # claimed by somebody else in the meantime
+            with os.fdopen(fd, 'w') as fp:
+                json.dump({'taleId': str(tale_id), 'login': login}, fp)
+            claimed = PooledContainer(id=volume.name, path=mountpoint,
+                                      host=cli.info()['Swarm']['NodeID'])
+            break
+
+        with self._lock:
+            if claimed is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        try:
+            _get_redis().hincrby(
+                STATS_KEY.format(cli.info()['Swarm']['NodeID']),
+                'hits' if claimed else 'misses', 1)
+        except redis.RedisError as e:
+            logging.warning('Unable to count the pool %s: %s',
+                            'hit' if claimed else 'miss', e)
+        logging.info('Volume pool %s (hit rate %.2f)',
+                     'hit' if claimed else 'miss', self.hit_rate)
+        self.refill_async(cli)
+        return claimed
+
+    def refill(self, cli):
+        """Create pooled volumes until the target size is reached."""
+        with open(self._lock_path, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return  # another process on this node is refilling
+            missing = self.size - len(self._available(cli))
+            for _ in range(max(missing, 0)):
+                name = 'wtpool_%s' % new_user(12)
+                volume = cli.volumes.create(name=name, driver='local',
+                                            labels={POOL_LABEL: 'true'})
+                mountpoint = volume.attrs['Mountpoint']
+                for path in ('data', 'home'):
+                    _safe_mkdir(HOSTDIR + os.path.join(mountpoint, path))
+                logging.info('Added volume %s to the pool', name)
+
+    def _refill(self, cli):
+        try:
+            self.refill(cli)
+        except (DockerException, OSError) as e:
+            logging.error('Failed to refill the volume pool: %s', e)
+
+    def refill_async(self, cli):
+        """Refill the pool in a background thread."""
+        if self.size <= 0:
+            return
+        with self._lock:
+            if self._refill_thread is not None and \
+                    self._refill_thread.is_alive():
+                return
+            self._refill_thread = threading.Thread(
+                target=self._refill, args=(cli,), name='volume-pool-refill')
+            self._refill_thread.daemon = True
+            self._refill_thread.start()
+
+
+VOLUME_POOL = VolumePool()
@@ -1,9 +1,12 @@
 import io
 import tempfile
 import logging
+import threading
+import time
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from urllib.request import urlopen
-from shutil import copyfileobj
 import uuid
 import requests
 import yaml as yaml
@@ -16,12 +19,16 @@ from d1_common.types.exceptions import DataONEException
 
 from .utils import \
     check_pid, \
-    get_file_item, \
+    ItemMetadataCache, \
     compute_md5, \
+    IteratorReader, \
+    download_file_md5, \
     extract_user_id, \
     filter_items, \
-    get_dataone_package_url
+    get_dataone_package_url, \
+    SPOOL_MAX_SIZE
 
+from .cache import MD5_CACHE, ENVIRONMENT_CACHE
 from .dataone_metadata import \
     generate_system_metadata, \
     create_minimum_eml, \
@@ -31,7 +38,134 @@ from .constants import \
     ExtraFileNames, \
     license_files, \
     GIRDER_API_URL, \
-    API_VERSION
+    API_VERSION, \
+    DATAONE_MAX_CONCURRENCY
+
+
+class UploadLimiter(object):
+    """
+    An adaptive limit on the number of concurrent uploads to a member node.
+
+    The limit starts low and grows additively while uploads succeed. It is
+    halved whenever an upload fails or takes much longer than usual. Upload
+    times are normalized by the object size (with small objects counted as
+    `LATENCY_UNIT` bytes), so that large files aren't mistaken for spikes.
+    """
+    LATENCY_UNIT = 1024 ** 2
+    SPIKE_FACTOR = 3.0
+
+    def __init__(self, max_limit, initial=1):
+        self.max_limit = max(1, max_limit)
+        self.limit = float(min(initial, self.max_limit))
+        self.active = 0
+        self.latency = None
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Block until another upload is allowed to start."""
+        with self._cond:
+            while self.active >= int(self.limit):
+                self._cond.wait()
+            self.active += 1
+
+    def release(self, success, elapsed, size):
+        """
+        Record the outcome of an upload and adjust the limit.
+
+        :param success: Whether the upload succeeded
+        :param elapsed: How long the upload took in seconds
+        :param size: The size of the uploaded object in bytes
+        :type success: bool
+        :type elapsed: float
+        :type size: int
+        """
+        latency = elapsed / max(size or 0, self.LATENCY_UNIT)
+        with self._cond:
+            self.active -= 1
+            spike = self.latency is not None and \
+                latency > self.SPIKE_FACTOR * self.latency
+            if not success or spike:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.max_limit),
+                                 self.limit + 1.0 / int(self.limit))
+            if success:
+                self.latency = latency if self.latency is None else \
+                    0.8 * self.latency + 0.2 * latency
+            self._cond.notify_all()
+
+
+"""
+A stage of the publishing process. `func` is called with a dict that holds the
+results of the stages listed in `depends`, keyed by their names.
+"""
+Stage = namedtuple('Stage', ['name', 'func', 'depends'])
+
+
+def run_stages(stages):
+    """
+    Runs a graph of stages, starting each one as soon as all of its dependencies
+    have finished. Independent stages run concurrently. If a stage raises, no new
+    stages are started and the exception is propagated.
+
+    :param stages: The stages that make up the graph
+    :type stages: list
+    :return: The result and the wall time in seconds of each stage, keyed by name
+    :rtype: tuple
+    """
+    pending = {stage.name: stage for stage in stages}
+    for stage in stages:
+        unknown = set(stage.depends) - set(pending)
+        if unknown:
+            raise ValueError('Stage {} depends on unknown stages {}'.format(
+                stage.name, ', '.join(sorted(unknown))))
+
+    results = dict()
+    timings = dict()
+
+    def run(stage, inputs):
+        tic = time.time()
+        try:
+            return stage.func(inputs)
+        finally:
+            timings[stage.name] = time.time() - tic
+
+    running = dict()
+    with ThreadPoolExecutor(max_workers=len(stages) or 1) as executor:
+        while pending or running:
+            for stage in list(pending.values()):
+                if all(dep in results for dep in stage.depends):
+                    inputs = {dep: results[dep] for dep in stage.depends}
+                    running[executor.submit(run, stage, inputs)] = stage.name
+                    del pending[stage.name]
+            if not running:
+                raise ValueError('Stages {} have circular dependencies'.format(
+                    ', '.join(sorted(pending))))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results, timings
+
+
+# One limiter per member node, shared by all publish jobs in this process
+_upload_limiters = dict()
+_upload_limiters_lock = threading.Lock()
+
+
+def get_upload_limiter(dataone_node):
+    """
+    Returns the upload limiter of a member node.
+
+    :param dataone_node: The DataONE member node endpoint
+    :type dataone_node: str
+    :return: The limiter shared by all the uploads to the node
+    :rtype: UploadLimiter
+    """
+    with _upload_limiters_lock:
+        if dataone_node not in _upload_limiters:
+            _upload_limiters[dataone_node] = \
+                UploadLimiter(DATAONE_MAX_CONCURRENCY)
+        return _upload_limiters[dataone_node]
 
 
 def create_upload_eml(tale,
@@ -41,7 +175,8 @@ def create_upload_eml(tale,
                       license_id,
                       user_id,
                       file_sizes,
-                      gc):
+                      gc,
+                      cache=None):
     """
     Creates the EML metadata document along with an additional metadata document
     and uploads them both to DataONE. A pid is created for the EML document, and is
@@ -57,6 +192,7 @@ def create_upload_eml(tale,
      (like tale.yml) .The size needs to be in the EML record so pass them
       in here. The size should be described in bytes
     :param gc: The girder client
+    :param cache: The metadata cache of the job
     :type tale: wholetale.models.tale
     :type client: MemberNodeClient_2_0
     :type user: girder.models.user
@@ -64,6 +200,7 @@ def create_upload_eml(tale,
     :type license_id: str
     :type user_id: str
     :type file_sizes: dict
+    :type cache: ItemMetadataCache
     :return: pid of the EML document
     :rtype: str
     """
@@ -77,7 +214,8 @@ def create_upload_eml(tale,
                                  file_sizes,
                                  license_id,
                                  user_id,
-                                 gc)
+                                 gc,
+                                 cache)
     # Create the metadata describing the EML document
     meta = generate_system_metadata(pid=eml_pid,
                                     format_id='eml://ecoinformatics.org/eml-2.1.1',
@@ -93,59 +231,52 @@ def create_upload_eml(tale,
     return eml_pid
 
 
-def create_external_object_structure(external_files, user, gc):
+def create_external_object_structure(external_files, user, gc, cache=None):
     """
     Creates a JSON file that describes a remote which has the following format
      {file_name : {'url': url, 'md5': md5}
-     We'll want to compute the md5, so we have to save the file
-     temporarily.
+     The md5 is computed while the remote object is streamed.
 
     :param external_files: A list of files that exist outside WholeTale
     :param user: The user publishing the tale
     :param gc: The girder client
+    :param cache: The metadata cache of the job
     :type external_files: list
     :type user: girder.mnodels.user
+    :type cache: ItemMetadataCache
     :return: A dictionary that lists each remote file with its md5
     :rtype: dict
     """
 
     reference_file = dict()
+    if cache is None:
+        cache = ItemMetadataCache(gc)
 
     for item in external_files:
         """
         Get the underlying file object from the supplied item id.
         We'll need the `linkUrl` field to determine where it is pointing to.
         """
-        file = get_file_item(item, gc)
+        file = cache.get_file(item)
         if file is not None:
             url = file.get('linkUrl', None)
             if url is not None:
+                try:
+                    # Hash the remote object as it streams in, nothing is stored
+                    md5 = compute_md5(urlopen(url))
+                except requests.exceptions.HTTPError:
+                    # if we fail to download the file, exit
+                    return 'There was a problem downloading an external file, {} ' \
+                           'located at {}.'.format(file['name'], url)
+                digest = md5.hexdigest()
+
                 """
-                Create a temporary file object which will eventually hold the contents
-                of the remote object.
+                Create dictionary entries for the file. We key off of the file name,
+                and store the url and md5 with it.
                 """
-                with tempfile.NamedTemporaryFile() as temp_file:
-                    try:
-                        src = urlopen(url)
-                        # Copy the response into the temporary file
-                        copyfileobj(src, temp_file)
-
-                    except requests.exceptions.HTTPError:
-                        # if we fail to download the file, exit
-                        return 'There was a problem downloading an external file, {} ' \
-                               'located at {}.'.format(file['name'], url)
-
-                    # Get the md5 of the file
-                    md5 = compute_md5(temp_file)
-                    digest = md5.hexdigest()
-
-                    """
-                    Create dictionary entries for the file. We key off of the file name,
-                    and store the url and md5 with it.
-                    """
-                    url_entry = {'url': url}
-                    md5_entry = {'md5': digest}
-                    reference_file[file['name']] = url_entry, md5_entry
+                url_entry = {'url': url}
+                md5_entry = {'md5': digest}
+                reference_file[file['name']] = url_entry, md5_entry
 
     return reference_file
 
@@ -165,6 +296,21 @@ def create_dataone_client(mn_base_url, auth_token):
     return MemberNodeClient_2_0(mn_base_url, **auth_token)
 
 
+def _object_buffer(size):
+    """
+    Returns a buffer for an object of a known size that is about to be uploaded.
+    Objects up to `SPOOL_MAX_SIZE` are held in memory, larger ones go to disk, so
+    memory use doesn't grow with the largest file of a tale.
+
+    :param size: The size of the object in bytes
+    :type size: int
+    :return: An empty file object open for writing and reading
+    """
+    if size <= SPOOL_MAX_SIZE:
+        return io.BytesIO()
+    return tempfile.TemporaryFile()
+
+
 def upload_file(client, pid, file_object, system_metadata):
     """
     Uploads two files to a DataONE member node. The first is an object, which is just a data file.
@@ -176,7 +322,7 @@ def upload_file(client, pid, file_object, system_metadata):
     :param system_metadata: The metadata object describing the file object
     :type client: MemberNodeClient_2_0
     :type pid: str
-    :type file_object: str
+    :type file_object: str, bytes or file
     :type system_metadata: d1_common.types.generated.dataoneTypes_v2_0.SystemMetadata
     """
 
@@ -187,12 +333,14 @@ def upload_file(client, pid, file_object, system_metadata):
         return 'Error uploading file to DataONE. {0}'.format(str(e))
 
 
-def create_paths_structure(item_ids, gc):
+def create_paths_structure(item_ids, gc, cache=None):
     """
     Creates a file that lists the path that each item is located at.
     :param item_ids: A list of items that are in the tale
     :param gc: The girder client
+    :param cache: The metadata cache of the job
     :type item_ids: list
+    :type cache: ItemMetadataCache
     :return: The dict representing the file structure
     :rtype: dict
     """
@@ -202,11 +350,12 @@ def create_paths_structure(item_ids, gc):
      convenience.
     """
     path_file = dict()
+    if cache is None:
+        cache = ItemMetadataCache(gc)
 
     for item_id in item_ids:
-        item = gc.getItem(item_id)
-        path = gc.get('resource/{}/path?type=item'.format(item_id))
-        path_file[item['name']] = path
+        item = cache.get_item(item_id)
+        path_file[item['name']] = cache.get_path(item_id)
 
     return path_file
 
@@ -276,7 +425,8 @@ def create_upload_tale_yaml(tale,
                             client,
                             prov_info,
                             rights_holder,
-                            gc):
+                            gc,
+                            cache=None):
     """
     The yaml content is represented with Python dicts, and then dumped to
      the yaml object.
@@ -289,6 +439,7 @@ def create_upload_tale_yaml(tale,
     is gathered in the UI and passed through the REST endpoint.
     :param rights_holder: The owner of this object
     :param gc: The girder client
+    :param cache: The metadata cache of the job
     :type tale: wholetale.models.Tale
     :type remote_objects: list
     :type item_ids: list
@@ -296,6 +447,7 @@ def create_upload_tale_yaml(tale,
     :type client: MemberNodeClient_2_0
     :type prov_info: dict
     :type rights_holder: str
+    :type cache: ItemMetadataCache
     :return: The pid and the size of the file
     :rtype: tuple
     """
@@ -305,12 +457,12 @@ def create_upload_tale_yaml(tale,
 
     # Create the dict that holds the file paths
     file_paths = dict()
-    file_paths['paths'] = create_paths_structure(item_ids, gc)
+    file_paths['paths'] = create_paths_structure(item_ids, gc, cache)
 
     # Create the dict that tracks externally defined objects, if applicable
     external_files = dict()
     if len(remote_objects) > 0:
-        external_files['external files'] = create_external_object_structure(remote_objects, user, gc)
+        external_files['external files'] = create_external_object_structure(remote_objects, user, gc, cache)
 
     # Append all of the information together
     yaml_file = dict(tale_info)
@@ -398,31 +550,78 @@ def create_upload_object_metadata(client, file_object, rights_holder, gc):
     :type client: MemberNodeClient_2_0
     :type file_object: girder.models.file
     :type rights_holder: str
-    :return: The pid of the object
+    :return: The pid of the object or None if the upload failed
     :rtype: str
     """
 
     # PID for the metadata object
     pid = str(uuid.uuid4())
-    with tempfile.NamedTemporaryFile() as temp_file:
-        gc.downloadFile(file_object['_id'], temp_file.name)
-        temp_file.seek(0)
+    digest = MD5_CACHE.get(file_object)
+    with _object_buffer(file_object['size']) as temp_file:
+        if digest is None:
+            # Hash the file while it streams in, then upload from the handle
+            digest = download_file_md5(file_object['_id'], temp_file, gc).hexdigest()
+            MD5_CACHE.put(file_object, digest)
+            source = temp_file
+        else:
+            # The checksum is known, stream the file from Girder straight to DataONE
+            source = IteratorReader(gc.downloadFileAsIterator(file_object['_id']),
+                                    file_object['size'])
         meta = generate_system_metadata(pid,
                                         format_id=file_object['mimeType'],
-                                        file_object=temp_file,
+                                        file_object=source,
                                         name=file_object['name'],
                                         is_file=True,
                                         rights_holder=rights_holder,
-                                        size=file_object['size'])
-        temp_file.seek(0)
-        upload_file(client=client,
-                    pid=pid,
-                    file_object=temp_file.read(),
-                    system_metadata=meta)
+                                        size=file_object['size'],
+                                        md5=digest)
+        error = upload_file(client=client,
+                            pid=pid,
+                            file_object=source,
+                            system_metadata=meta)
+        if error:
+            logging.warning('Failed to upload {}: {}'.format(file_object['name'], error))
+            return None
         logging.info('Uploaded file to DataONE, PID {}'.format(pid))
     return pid
 
-    return pid
+
+def upload_local_files(client, file_objects, rights_holder, gc, dataone_node):
+    """
+    Uploads files that exist on the Girder filesystem to DataONE, running several
+    uploads at a time. The number of concurrent uploads adapts to how well the
+    member node keeps up and never exceeds `DATAONE_MAX_CONCURRENCY`.
+
+    :param client: The client to the DataONE member node
+    :param file_objects: The files that will be uploaded
+    :param rights_holder: The owner of the objects
+    :param gc: The girder client
+    :param dataone_node: The DataONE member node endpoint
+    :type client: MemberNodeClient_2_0
+    :type file_objects: list
+    :type rights_holder: str
+    :type dataone_node: str
+    :return: The pids of the objects, in the order of file_objects. A pid is None
+     if the upload failed.
+    :rtype: list
+    """
+    limiter = get_upload_limiter(dataone_node)
+
+    def upload(file_object):
+        limiter.acquire()
+        tic = time.time()
+        pid = None
+        try:
+            pid = create_upload_object_metadata(client, file_object, rights_holder, gc)
+        finally:
+            limiter.release(pid is not None, time.time() - tic,
+                            file_object.get('size'))
+        return pid
+
+    if not file_objects:
+        return list()
+    with ThreadPoolExecutor(max_workers=limiter.max_limit) as executor:
+        return list(executor.map(upload, file_objects))
 
 
 def create_upload_repository(tale, client, rights_holder, gc):
@@ -441,39 +640,37 @@ def create_upload_repository(tale, client, rights_holder, gc):
     try:
         image = gc.get('/image/{}'.format(tale['imageId']))
         recipe = gc.get('/recipe/{}'.format(image['recipeId']))
-        download_url = recipe['url'] + '/tarball/' + recipe['commitId']
-
-        with tempfile.NamedTemporaryFile() as temp_file:
-            src = urlopen(download_url)
-            try:
-                # Copy the response into the temporary file
-                copyfileobj(src, temp_file)
-                logging.debug('Copied file, size: {}'.format(temp_file.tell()))
-
-            except IOError as e:
-                error_msg = 'Error copying environment file to disk. {}'.format(e)
-                logging.warning(error_msg)
-
-                # We should stop if we can't upload the repository
-                return error_msg
-        # Create a pid for the file
+
+        try:
+            # Commits are immutable, so the tarball and its md5 can be reused
+            tarball = ENVIRONMENT_CACHE.fetch(recipe['url'], recipe['commitId'])
+            logging.debug('Environment tarball size: {}'.format(tarball.size))
+
+        except IOError as e:
+            error_msg = 'Error copying environment file to disk. {}'.format(e)
+            logging.warning(error_msg)
+
+            # Leave the repository out of the package, like any other failure
+            return None, 0
+
+        with open(tarball.path, 'rb') as tarball_file:
+            # Create a pid for the file
             pid = str(uuid.uuid4())
-        # Create system metadata for the file
-            temp_file.seek(0)
+            # Create system metadata for the file
             meta = generate_system_metadata(pid=pid,
                                             format_id='application/tar+gzip',
-                                            file_object=temp_file.read(),
+                                            file_object=tarball_file,
                                             name=ExtraFileNames.environment_file,
-                                            rights_holder=rights_holder)
-            temp_file.seek(0)
+                                            rights_holder=rights_holder,
+                                            is_file=True,
+                                            size=tarball.size,
+                                            md5=tarball.md5)
             logging.debug('Uploading repository to DataONE')
             upload_file(client=client,
                         pid=pid,
-                        file_object=io.BytesIO(temp_file.read()),
+                        file_object=tarball_file,
                         system_metadata=meta)
-
-            size = os.path.getsize(temp_file.name)
-        return pid, size
+        return pid, tarball.size
 
     except IOError as e:
         logging.debug('Failed to process repository'.format(e))
@@ -554,91 +751,130 @@ def publish_tale(item_ids,
                ' ensure you are logged into DataONE.'
 
     """
-    Sort all of the input files based on where they are located,
-        1. HTTP resource
-        2. DataONE resource
-        3. Local filesystem object
-    """
-    filtered_items = filter_items(item_ids, gc)
-
-    """
-    Iterate through the list of objects that are local (ie files without a `linkUrl`
-    and upload them to DataONE. The call to create_upload_object_metadata will
-     return a pid that describes the object (not the metadata object). We'll save
-        this pid so that we can pass it to the resource map.
-    """
-    local_file_pids = list()
-    for file in filtered_items['local_files']:
-        logging.debug('Processing local files for DataONE upload')
-        local_file_pids.append(create_upload_object_metadata(client, file, user_id, gc))
-
-    logging.debug('Processing Tale YAML file')
-    remote_items = filtered_items['remote'] + filtered_items['dataone']
-
-    tale_yaml_pid, tale_yaml_length = create_upload_tale_yaml(tale,
-                                                              remote_items,
-                                                              item_ids,
-                                                              user,
-                                                              client,
-                                                              prov_info,
-                                                              user_id,
-                                                              gc)
-
-    """
-    Upload the license file
-    """
-    logging.debug('Uploading the license file')
-    license_pid, license_size = upload_license_file(client, license_id, user_id)
-
-    """
-    Upload the repository"""
-    repository_pid, repository_size = create_upload_repository(tale, client, user_id, gc)
-
-    """
-    
-    Create an EML document describing the data, and then upload it. Save the
-    pid for the resource map.
+    Publishing is expressed as a graph of stages. Each stage receives the results
+    of the stages it depends on, and stages without a dependency between them run
+    concurrently.
     """
-    file_sizes = {'tale_yaml': tale_yaml_length,
-                  'license': license_size,
-                  'repository': repository_size}
+    # Girder metadata of the items is fetched once and shared by all the stages
+    cache = ItemMetadataCache(gc)
 
-    """
-    Get all of the items, except the ones that were transferred from an external
-    source
-    """
-    eml_items = filtered_items.get('dataone') + \
-        filtered_items.get('local_items') + filtered_items.get('remote')
+    def sort_items(results):
+        """
+        Sort all of the input files based on where they are located,
+            1. HTTP resource
+            2. DataONE resource
+            3. Local filesystem object
+        """
+        cache.prefetch(item_ids)
+        return filter_items(item_ids, gc, cache)
 
-    eml_items = filter(None, eml_items)
-    eml_items = list(eml_items)
-    logging.debug('Creating DataONE EML record for new Tale')
-    eml_pid = create_upload_eml(tale,
-                                client,
-                                user,
-                                eml_items,
-                                license_id,
-                                extract_user_id(dataone_auth_token),
-                                file_sizes,
-                                gc)
-    # Check eml file status. If it failed, we need to exit and let the user know
-    logging.debug('Finished creating DataONE EML record')
+    def upload_local(results):
+        """
+        Upload the objects that are local (ie files without a `linkUrl`) to DataONE.
+        Each upload returns a pid that describes the object (not the metadata object).
+        We'll save these pids so that we can pass them to the resource map.
+        """
+        logging.debug('Processing local files for DataONE upload')
+        return upload_local_files(client,
+                                  results['filter']['local_files'],
+                                  user_id,
+                                  gc,
+                                  dataone_node)
+
+    def upload_tale_yaml(results):
+        logging.debug('Processing Tale YAML file')
+        filtered_items = results['filter']
+        remote_items = filtered_items['remote'] + filtered_items['dataone']
+        return create_upload_tale_yaml(tale,
+                                       remote_items,
+                                       item_ids,
+                                       user,
+                                       client,
+                                       prov_info,
+                                       user_id,
+                                       gc,
+                                       cache)
+
+    def upload_license(results):
+        logging.debug('Uploading the license file')
+        return upload_license_file(client, license_id, user_id)
+
+    def upload_repository(results):
+        return create_upload_repository(tale, client, user_id, gc)
+
+    def upload_eml(results):
+        """
+        Create an EML document describing the data, and then upload it. Save the
+        pid for the resource map.
+        """
+        _, tale_yaml_size = results['tale_yaml']
+        _, license_size = results['license']
+        _, repository_size = results['repository']
+        file_sizes = {'tale_yaml': tale_yaml_size,
+                      'license': license_size,
+                      'repository': repository_size}
 
-    """
-    Once all objects are uploaded, create and upload the resource map. This file describes
-    the object relations (ie the package). This should be the last file that is uploaded.
-    Also filter out any pids that are None, which would have resulted from an error. This
-    prevents referencing objects that failed to upload.
-    """
-    upload_objects = list(local_file_pids + [tale_yaml_pid, license_pid, repository_pid])
-    resmap_pid = str(uuid.uuid4())
-    logging.debug('Creating DataONE resource map')
-    create_upload_resmap(resmap_pid,
-                         eml_pid,
-                         upload_objects,
-                         client,
-                         user_id)
-    logging.debug('Finished creating DataONE resource map')
-    package_url = get_dataone_package_url(dataone_node, resmap_pid)
+        """
+        Get all of the items, except the ones that were transferred from an external
+        source
+        """
+        filtered_items = results['filter']
+        eml_items = filtered_items.get('dataone') + \
+            filtered_items.get('local_items') + filtered_items.get('remote')
+
+        eml_items = filter(None, eml_items)
+        eml_items = list(eml_items)
+        logging.debug('Creating DataONE EML record for new Tale')
+        eml_pid = create_upload_eml(tale,
+                                    client,
+                                    user,
+                                    eml_items,
+                                    license_id,
+                                    extract_user_id(dataone_auth_token),
+                                    file_sizes,
+                                    gc,
+                                    cache)
+        logging.debug('Finished creating DataONE EML record')
+        return eml_pid
+
+    def upload_resmap(results):
+        """
+        Once all objects are uploaded, create and upload the resource map. This file
+        describes the object relations (ie the package). This should be the last file
+        that is uploaded. Also filter out any pids that are None, which would have
+        resulted from an error. This prevents referencing objects that failed to upload.
+        """
+        tale_yaml_pid, _ = results['tale_yaml']
+        license_pid, _ = results['license']
+        repository_pid, _ = results['repository']
+        upload_objects = results['local_files'] + [tale_yaml_pid,
+                                                   license_pid,
+                                                   repository_pid]
+        upload_objects = [pid for pid in upload_objects if pid is not None]
+        resmap_pid = str(uuid.uuid4())
+        logging.debug('Creating DataONE resource map')
+        create_upload_resmap(resmap_pid,
+                             results['eml'],
+                             upload_objects,
+                             client,
+                             user_id)
+        logging.debug('Finished creating DataONE resource map')
+        return resmap_pid
+
+    results, timings = run_stages([
+        Stage('filter', sort_items, ()),
+        Stage('local_files', upload_local, ('filter',)),
+        Stage('tale_yaml', upload_tale_yaml, ('filter',)),
+        Stage('license', upload_license, ()),
+        Stage('repository', upload_repository, ()),
+        Stage('eml', upload_eml, ('filter', 'tale_yaml', 'license', 'repository')),
+        Stage('resmap', upload_resmap, ('local_files', 'tale_yaml', 'license',
+                                        'repository', 'eml')),
+    ])
+    logging.info('Checksum cache: {}'.format(MD5_CACHE.stats()))
+    logging.info('Publish stage timings: {}'.format(
+        ', '.join('{}={:.2f}s'.format(name, elapsed)
+                  for name, elapsed in sorted(timings.items()))))
+    package_url = get_dataone_package_url(dataone_node, results['resmap'])
 
     return package_url
@@ -1,4 +1,5 @@
 """A set of WT related Girder tasks."""
+from concurrent.futures import ThreadPoolExecutor
 from distutils.version import StrictVersion
 import os
 import shutil
@@ -16,42 +17,46 @@ except ImportError:
     from urllib.parse import urlparse
 from girder_worker.utils import girder_job
 from girder_worker.app import app
-# from girder_worker.plugins.docker.executor import _pull_image
 from .utils import \
-    HOSTDIR, REGISTRY_USER, REGISTRY_URL, REGISTRY_PASS, \
+    HOSTDIR, REGISTRY_URL, DOMAIN, INSTANCE_URL_SCHEME, LAUNCH_TIMEOUT, \
     _parse_request_body, new_user, _safe_mkdir, _get_api_key, \
-    _get_container_config, _launch_container
+    _invalidate_api_key, _get_container_config, _launch_container, \
+    _get_docker_client, _with_registry_auth, _wait_for_service, _wait_for_server, \
+    _download_folder, _girderfs_mount, _girderfs_unmount, _is_mounted, \
+    _mount_stats, _acquire_shared_mount, _release_shared_mount
+from . import images
+from .admission import admit
+from .cache import NARRATIVE_CACHE
+from .pool import VOLUME_POOL
 from .publish import publish_tale
 from .constants import API_VERSION
 
 DEFAULT_USER = 1000
 DEFAULT_GROUP = 100
+LAUNCH_TALE_STEPS = 4
 
 
-@girder_job(title='Create Tale Data Volume')
-@app.task
-def create_volume(payload):
-    """Create a mountpoint and compose WT-fs."""
+def _check_api(payload):
     api_check = payload.get('api_version', '1.0')
     if StrictVersion(api_check) != StrictVersion(API_VERSION):
         logging.error('Unsupported API (%s) (server API %s)' %
                       (api_check, API_VERSION))
 
-    gc, user, tale = _parse_request_body(payload)
-    vol_name = "%s_%s_%s" % (tale['_id'], user['login'], new_user(6))
-    cli = docker.from_env(version='1.28')
-
-    try:
-        volume = cli.volumes.create(name=vol_name, driver='local')
-    except DockerException as dex:
-        logging.error('Error pulling Docker image blah')
-        logging.exception(dex)
-    logging.info("Volume: %s created", volume.name)
-    mountpoint = volume.attrs['Mountpoint']
-    logging.info("Mountpoint: %s", mountpoint)
 
+def _populate_volume(gc, user, tale, cli, vol_name, mountpoint):
+    """Fill a new volume with the narrative and mount WT-fs in it."""
+    transfer = None
     try:
-        gc.downloadFolderRecursive(tale['narrativeId'], mountpoint)
+        # Ownership is set while the files are written, no walk needed after
+        if NARRATIVE_CACHE.enabled:
+            transfer = NARRATIVE_CACHE.populate(
+                gc, tale['narrativeId'], mountpoint,
+                DEFAULT_USER, DEFAULT_GROUP)
+        else:
+            transfer = _download_folder(gc, tale['narrativeId'], mountpoint,
+                                        DEFAULT_USER, DEFAULT_GROUP)
+        logging.info("Narrative: %(files)d files, %(bytes)d bytes "
+                     "downloaded", transfer)
     except KeyError:
         pass  # no narrativeId
     except girder_client.HttpError:
@@ -60,9 +65,6 @@ def create_volume(payload):
         pass
 
     os.chown(HOSTDIR + mountpoint, DEFAULT_USER, DEFAULT_GROUP)
-    for root, dirs, files in os.walk(HOSTDIR + mountpoint):
-        for obj in dirs + files:
-            os.chown(os.path.join(root, obj), DEFAULT_USER, DEFAULT_GROUP)
 
     # Before calling girderfs and "escaping" container, we need to make
     # sure that shared objects we use are available on the host
@@ -83,74 +85,227 @@ def create_volume(payload):
     for directory in (data_dir, home_dir):
         if not os.path.isdir(directory):
             os.makedirs(directory)
-    api_key = _get_api_key(gc)
-
-    if tale.get('folderId'):
-        cmd = "girderfs --hostns -c remote --api-url {} --api-key {} {} {}".format(
-            gc.urlBase, api_key, data_dir, tale['folderId'])
-        logging.info("Calling: %s", cmd)
-        subprocess.call(cmd, shell=True)
-    #  webdav relies on mount.c module, don't use hostns for now
-    cmd = 'girderfs -c wt_home --api-url '
-    cmd += '{} --api-key {} {} {}'.format(
-        gc.urlBase, api_key, home_dir, homeDir['_id'])
-    logging.info("Calling: %s", cmd)
-    subprocess.call(cmd, shell=True)
-    payload.update(
-        dict(
-            nodeId=cli.info()['Swarm']['NodeID'],
-            mountPoint=mountpoint,
-            volumeName=volume.name
-        )
+
+    def mount(api_key):
+        data_mount = None
+        if tale.get('folderId'):
+            data_mount = _acquire_shared_mount(tale['folderId'], vol_name,
+                                               gc.urlBase, api_key)
+        #  webdav relies on mount.c module, don't use hostns for now
+        _girderfs_mount('wt_home', gc.urlBase, api_key, home_dir,
+                        homeDir['_id'])
+        return data_mount
+
+    try:
+        data_mount = mount(_get_api_key(gc))
+    except RuntimeError as e:
+        # The cached key may have been revoked, look it up again
+        logging.warning("Mount failed, retrying with a fresh API key: %s", e)
+        _invalidate_api_key(gc)
+        data_mount = mount(_get_api_key(gc))
+    return transfer, data_mount
+
+
+def _discard_volume(cli, vol_name, mountpoint):
+    """Undo a volume that couldn't be set up: drop its mounts and remove it."""
+    for suffix in ('data', 'home'):
+        path = os.path.join(mountpoint, suffix)
+        if _is_mounted(path):
+            _girderfs_unmount(path)
+    _release_shared_mount(vol_name)
+    try:
+        cli.volumes.get(vol_name).remove()
+    except DockerException as e:
+        logging.error("Unable to remove volume [%s]: %s", vol_name, e)
+
+
+def _create_volume(gc, user, tale, cli):
+    """Create the volume of an instance and mount WT-fs in it."""
+    pooled = VOLUME_POOL.claim(cli, tale['_id'], user['login'])
+    if pooled is not None:
+        vol_name = pooled.id
+        mountpoint = pooled.path
+        logging.info("Volume: %s claimed from the pool", vol_name)
+    else:
+        vol_name = "%s_%s_%s" % (tale['_id'], user['login'], new_user(6))
+        try:
+            volume = cli.volumes.create(name=vol_name, driver='local')
+        except DockerException as dex:
+            logging.error('Error creating Docker volume %s', vol_name)
+            logging.exception(dex)
+            raise
+        logging.info("Volume: %s created", volume.name)
+        mountpoint = volume.attrs['Mountpoint']
+    logging.info("Mountpoint: %s", mountpoint)
+
+    try:
+        transfer, data_mount = _populate_volume(gc, user, tale, cli,
+                                                vol_name, mountpoint)
+    except Exception:
+        logging.error("Unable to set up volume %s, removing it", vol_name)
+        _discard_volume(cli, vol_name, mountpoint)
+        raise
+    return dict(
+        nodeId=cli.info()['Swarm']['NodeID'],
+        mountPoint=mountpoint,
+        volumeName=vol_name,
+        dataMount=data_mount,
+        narrativeTransfer=transfer
+    )
+
+
+def _pull_image(cli, image):
+    """Pull the image if it's missing on this node, return True if it was."""
+    if images.is_cached(cli, image):
+        return False
+    logging.info('Cold image %s pulled in %.1fs', image, images.pull(cli, image))
+    return True
+
+
+def _start_service(payload, cli, container_config, cold):
+    """Start the service of an instance and wait until it answers."""
+    images.record_launch(container_config.image, payload['nodeId'], cold)
+    if cold:
+        prefetch_images.delay()
+    tic = time.time()
+    deadline = tic + float(payload.get('launchTimeout', LAUNCH_TIMEOUT))
+    service, urlPath = _launch_container(
+        payload['volumeName'], payload['nodeId'],
+        container_config=container_config,
+        data_mount=payload.get('dataMount'))
+
+    # wait until task is started and the server answers through the proxy
+    ready = _wait_for_service(cli, service,
+                              payload['nodeId'], tic, deadline)
+    if ready:
+        url = '{}://{}.{}/{}'.format(INSTANCE_URL_SCHEME, service.name, DOMAIN,
+                                     urlPath.lstrip('/'))
+        ready = _wait_for_server(url, deadline)
+    time_to_ready = time.time() - tic
+    if ready:
+        logging.info('Service %s ready in %.2fs', service.name, time_to_ready)
+    else:
+        logging.warning('Service %s not ready after %.2fs',
+                        service.name, time_to_ready)
+
+    return dict(
+        name=service.name,
+        urlPath=urlPath,
+        coldImage=cold,
+        timeToReady=round(time_to_ready, 2) if ready else None
     )
+
+
+def _queue_progress(task, total=None):
+    """Return a callback reporting the place of a task in the launch queue."""
+    def progress(position, eta):
+        if task.job_manager is None:
+            return
+        message = 'Waiting to launch, position {} in queue'.format(position)
+        if eta is not None:
+            message += ', about {:.0f}s left'.format(eta)
+        task.job_manager.updateProgress(total=total, current=0,
+                                        message=message)
+    return progress
+
+
+@girder_job(title='Create Tale Data Volume')
+@app.task(bind=True)
+def create_volume(self, payload):
+    """Create a mountpoint and compose WT-fs."""
+    _check_api(payload)
+    gc, user, tale = _parse_request_body(payload)
+    cli = _get_docker_client()
+    with admit(self, payload, cli.info()['Swarm']['NodeID'], 'create_volume',
+               _queue_progress(self)):
+        payload.update(_create_volume(gc, user, tale, cli))
     return payload
 
 
 @girder_job(title='Spawn Instance')
-@app.task
-def launch_container(payload):
+@app.task(bind=True)
+def launch_container(self, payload):
     """Launch a container using a Tale object."""
-    api_check = payload.get('api_version', '1.0')
-    if StrictVersion(api_check) != StrictVersion(API_VERSION):
-        logging.error('Unsupported API (%s) (server API %s)' %
-                      (api_check, API_VERSION))
-
+    _check_api(payload)
     gc, user, tale = _parse_request_body(payload)
-    # _pull_image()
     container_config = _get_container_config(gc, tale)  # FIXME
-    service, urlPath = _launch_container(
-        payload['volumeName'], payload['nodeId'],
-        container_config=container_config)
 
-    tic = time.time()
-    timeout = 10.0
+    # Pull the image up front when it's missing on this node, so that the
+    # launch history tells which launches paid for a cold image
+    cli = _get_docker_client()
+    with admit(self, payload, payload['nodeId'], 'launch_container',
+               _queue_progress(self)):
+        cold = False
+        if payload['nodeId'] == cli.info()['Swarm']['NodeID']:
+            cold = _pull_image(cli, container_config.image)
+        payload.update(_start_service(payload, cli, container_config, cold))
+    return payload
 
-    # wait until task is started
-    while time.time() - tic < timeout:
-        try:
-            started = service.tasks()[0]['Status']['State'] == 'running'
-        except IndexError:
-            started = False
-        if started:
-            break
-        time.sleep(0.2)
-
-    payload.update(
-        dict(
-            name=service.name,
-            urlPath=urlPath
-        )
-    )
+
+@girder_job(title='Launch Tale')
+@app.task(bind=True)
+def launch_tale(self, payload):
+    """
+    Create the volume and launch the container of a Tale in one task,
+    pulling the image while the narrative is downloaded.
+    """
+    _check_api(payload)
+
+    def progress(current, message):
+        if self.job_manager is not None:
+            self.job_manager.updateProgress(
+                total=LAUNCH_TALE_STEPS, current=current, message=message)
+
+    gc, user, tale = _parse_request_body(payload)
+    container_config = _get_container_config(gc, tale)
+    cli = _get_docker_client()
+
+    with admit(self, payload, cli.info()['Swarm']['NodeID'], 'launch_tale',
+               _queue_progress(self, LAUNCH_TALE_STEPS)):
+        progress(1, 'Creating volume and pulling image')
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            cold = executor.submit(_pull_image, cli, container_config.image)
+            payload.update(_create_volume(gc, user, tale, cli))
+            try:
+                progress(2, 'Waiting for image')
+                cold = cold.result()
+
+                progress(3, 'Starting instance')
+                payload.update(
+                    _start_service(payload, cli, container_config, cold))
+            except Exception:
+                # Girder never gets the volume name, clean up here
+                logging.error("Unable to launch tale %s, removing volume %s",
+                              tale['_id'], payload['volumeName'])
+                _discard_volume(cli, payload['volumeName'],
+                                payload['mountPoint'])
+                raise
+    progress(LAUNCH_TALE_STEPS,
+             'Instance ready' if payload['timeToReady'] is not None
+             else 'Instance started')
     return payload
 
 
+@app.task
+def prefetch_images(image_list=None):
+    """Pull the most launched tale images and evict cold ones on this node."""
+    cli = _get_docker_client()
+    node_id = cli.info()['Swarm']['NodeID']
+    pulled = images.prefetch(cli, images=image_list)
+    removed = images.evict(cli, node_id, keep=pulled)
+    cold = images.cold_launches()
+    logging.info('Images most often pulled during a launch: %s', cold)
+    return {'nodeId': node_id, 'pulled': pulled, 'removed': removed,
+            'coldLaunches': cold}
+
+
 @girder_job(title='Shutdown Instance')
 @app.task
 def shutdown_container(payload):
     """Shutdown a running Tale."""
     gc, user, instance = _parse_request_body(payload)
 
-    cli = docker.from_env(version='1.28')
+    cli = _get_docker_client()
     if 'containerInfo' not in instance:
         return
     containerInfo = instance['containerInfo']  # VALIDATE
@@ -178,11 +333,12 @@ def remove_volume(payload):
         return
     containerInfo = instance['containerInfo']  # VALIDATE
 
-    cli = docker.from_env(version='1.28')
+    cli = _get_docker_client()
+    # data is only mounted in the volume by instances predating shared mounts
     for suffix in ('data', 'home'):
-        dest = os.path.join(containerInfo['mountPoint'], suffix)
-        logging.info("Unmounting %s", dest)
-        subprocess.call("umount %s" % dest, shell=True)
+        _girderfs_unmount(os.path.join(containerInfo['mountPoint'], suffix))
+    _release_shared_mount(containerInfo['volumeName'])
+    logging.info("Live mounts: %s", _mount_stats())
 
     try:
         volume = cli.volumes.get(containerInfo['volumeName'])
@@ -207,22 +363,18 @@ def build_image(image_id, repo_url, commit_id):
     subprocess.call(cmd, shell=True)
     subprocess.call('git checkout ' + commit_id, shell=True, cwd=temp_dir)
 
-    apicli = docker.APIClient(base_url='unix://var/run/docker.sock')
-    apicli.login(username=REGISTRY_USER, password=REGISTRY_PASS,
-                 registry=REGISTRY_URL)
+    cli = _get_docker_client()
     tag = urlparse(REGISTRY_URL).netloc + '/' + image_id
-    for line in apicli.build(path=temp_dir, pull=True, tag=tag):
+    for line in _with_registry_auth(cli, cli.api.build,
+                                    path=temp_dir, pull=True, tag=tag):
         print(line)
 
     # TODO: create tarball
     # remove clone
     shutil.rmtree(temp_dir, ignore_errors=True)
-    for line in apicli.push(tag, stream=True):
+    for line in _with_registry_auth(cli, cli.api.push, tag, stream=True):
         print(line)
 
-    cli = docker.from_env(version='1.28')
-    cli.login(username=REGISTRY_USER, password=REGISTRY_PASS,
-              registry=REGISTRY_URL)
     image = cli.images.get(tag)
     # Only image.attrs['Id'] is used in Girder right now
     return image.attrs
@@ -4,15 +4,23 @@
 
 """A set of helper routines for WT related tasks."""
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import os
 import random
 import re
 import string
+import subprocess
 import uuid
 import logging
+import fcntl
+import json
 import jwt
 import hashlib
+import inspect
+import threading
+import time
 
 try:
     from urlparse import urlparse
@@ -20,23 +28,56 @@ except ImportError:
     from urllib.parse import urlparse
 import docker
 import girder_client
+import redis
+import requests
 
 from .constants import \
     DataONELocations, \
     GIRDER_API_URL
 
 DOCKER_URL = os.environ.get("DOCKER_URL", "unix://var/run/docker.sock")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://redis/")
 HOSTDIR = os.environ.get("HOSTDIR", "/host")
 MAX_FILE_SIZE = os.environ.get("MAX_FILE_SIZE", 200)
+# Objects up to this size (in bytes) are buffered in memory while publishing
+SPOOL_MAX_SIZE = int(os.environ.get("SPOOL_MAX_SIZE", 16 * 1024 ** 2))
 TRAEFIK_NETWORK = os.environ.get("TRAEFIK_NETWORK", "traefik-net")
 TRAEFIK_ENTRYPOINT = os.environ.get("TRAEFIK_ENTRYPOINT", "http")
+INSTANCE_URL_SCHEME = os.environ.get("INSTANCE_URL_SCHEME", "https")
+LAUNCH_TIMEOUT = float(os.environ.get("LAUNCH_TIMEOUT", 60))
 DOMAIN = os.environ.get('DOMAIN', 'dev.wholetale.org')
 REGISTRY_USER = os.environ.get('REGISTRY_USER', 'fido')
 REGISTRY_URL = os.environ.get('REGISTRY_URL',
                               'https://registry.{}'.format(DOMAIN))
 REGISTRY_PASS = os.environ.get('REGISTRY_PASS')
+REGISTRY_LOGIN_TTL = int(os.environ.get('REGISTRY_LOGIN_TTL', 3600))
+# Girder clients kept per worker process and lifetime of cached /user/me
+GIRDER_SESSIONS = int(os.environ.get('GIRDER_SESSIONS', 32))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+API_KEY_CACHE_TTL = float(os.environ.get('API_KEY_CACHE_TTL', 3600))
+API_KEY_PAGE = 50
+IMAGE_CACHE_TTL = float(os.environ.get('IMAGE_CACHE_TTL', 300))
+CONTAINER_CONFIG_ENTRIES = 256
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 8))
+# Seconds of docker events read between checks of a starting task
+EVENT_WINDOW = 2.0
+MOUNT_TIMEOUT = float(os.environ.get('MOUNT_TIMEOUT', 30))
+SHARED_MOUNT_DIR = os.environ.get('SHARED_MOUNT_DIR',
+                                  '/var/lib/wholetale/mounts')
+# Read-only API key of a service account for the shared data mounts, the key
+# of the first launcher on the node is used when unset
+SHARED_MOUNT_API_KEY = os.environ.get('SHARED_MOUNT_API_KEY')
+# girderfs mounts of the node, keyed by mount path (a host path)
+MOUNT_REGISTRY = os.environ.get('MOUNT_REGISTRY',
+                                '/var/lib/wholetale/mounts.json')
+# Share of the limits of an instance reserved on its node, and how far the
+# reservations of a node may exceed its memory and cpus
+RESERVATION_RATIO = float(os.environ.get('RESERVATION_RATIO', 1.0))
+OVERCOMMIT_RATIO = float(os.environ.get('OVERCOMMIT_RATIO', 1.0))
+# Serializes the admission of services on a node (a host path)
+LAUNCH_LOCK = os.environ.get('LAUNCH_LOCK', '/var/lib/wholetale/launch.lock')
+NODE_LABEL = 'wholetale.node'
 
-MOUNTS = {}
 RETRIES = 5
 container_name_pattern = re.compile('tmp\.([^.]+)\.(.+)\Z')
 
@@ -68,22 +109,503 @@ def _safe_mkdir(dest):
         pass
 
 
+# Docker client shared by all the tasks of a worker process. The pid is
+# recorded so that a forked child never reuses its parent's connections.
+_docker = {'pid': None, 'client': None, 'login': None}
+_docker_lock = threading.Lock()
+
+
+_redis = {'pid': None, 'client': None}
+_redis_lock = threading.Lock()
+
+
+def _get_redis():
+    """Return the redis client of this worker process, used for shared state."""
+    with _redis_lock:
+        if _redis['pid'] != os.getpid():
+            _redis.update(pid=os.getpid(),
+                          client=redis.StrictRedis.from_url(REDIS_URL))
+        return _redis['client']
+
+
+_girder = {'pid': None, 'clients': OrderedDict(), 'users': {}}
+_girder_lock = threading.Lock()
+# tmpnb API keys of this worker process, keyed by (API URL, user id)
+_api_keys = {}
+# Image documents and the container configs built from them, per process
+_images = {}
+_container_configs = OrderedDict()
+_image_lock = threading.Lock()
+
+
+def _get_girder_client(api_url, token):
+    """
+    Return the Girder client of this worker process for a token. Clients
+    keep their connections alive and the least recently used are dropped.
+    """
+    key = (api_url, token)
+    with _girder_lock:
+        if _girder['pid'] != os.getpid():
+            _girder.update(pid=os.getpid(), clients=OrderedDict(), users={})
+        clients = _girder['clients']
+        gc = clients.pop(key, None)
+        if gc is None:
+            gc = girder_client.GirderClient(apiUrl=api_url)
+            gc.token = token
+            gc._session = requests.Session()
+        clients[key] = gc
+        while len(clients) > GIRDER_SESSIONS:
+            _, old = clients.popitem(last=False)
+            _girder['users'].pop(_user_key(old), None)
+            old._session.close()
+        return gc
+
+
+def _user_key(gc):
+    # urlBase rather than the API URL given, GirderClient appends a slash
+    return gc.urlBase, gc.token
+
+
+def _get_user(gc):
+    """Return /user/me for the client's token, cached for USER_CACHE_TTL."""
+    key = _user_key(gc)
+    now = time.time()
+    with _girder_lock:
+        users = _girder['users']
+        for expired in [k for k, v in users.items() if v[0] <= now]:
+            del users[expired]
+        cached = users.get(key)
+    if cached is not None:
+        return cached[1]
+    user = gc.get('/user/me')
+    if user is not None:
+        with _girder_lock:
+            _girder['users'][key] = (time.time() + USER_CACHE_TTL, user)
+    return user
+
+
+def _get_docker_client():
+    """Return the docker client of this worker process."""
+    with _docker_lock:
+        if _docker['pid'] != os.getpid():
+            _docker.update(pid=os.getpid(),
+                           client=docker.from_env(version='1.28'),
+                           login=None)
+        return _docker['client']
+
+
+def _registry_login(cli, force=False):
+    """Log the shared client into the registry, unless it recently did."""
+    with _docker_lock:
+        if not force and _docker['login'] is not None and \
+                time.time() - _docker['login'] < REGISTRY_LOGIN_TTL:
+            return
+        cli.login(username=REGISTRY_USER, password=REGISTRY_PASS,
+                  registry=REGISTRY_URL, reauth=force)
+        _docker['login'] = time.time()
+
+
+def _auth_error(message):
+    message = message.lower()
+    return any(word in message for word in
+               ('unauthorized', 'denied', 'authentication required'))
+
+
+def _stream_auth_error(chunk):
+    """Return whether a chunk of a docker JSON stream reports an auth error."""
+    if isinstance(chunk, dict):
+        lines = [chunk]
+    else:
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode('utf-8', 'replace')
+        lines = []
+        for line in chunk.splitlines():
+            try:
+                lines.append(json.loads(line))
+            except ValueError:
+                continue
+    return any(isinstance(line, dict) and line.get('errorDetail') and
+               _auth_error(line['errorDetail'].get('message', ''))
+               for line in lines)
+
+
+def _retry_stream(cli, stream, func, *args, **kwargs):
+    for chunk in stream:
+        yield chunk
+        if _stream_auth_error(chunk):
+            logging.info('Registry authorization failed, logging in again')
+            _registry_login(cli, force=True)
+            for chunk in func(*args, **kwargs):
+                yield chunk
+            return
+
+
+def _with_registry_auth(cli, func, *args, **kwargs):
+    """
+    Call func, logging in again and retrying once if the registry refused.
+
+    The low level build and push report a refusal as an errorDetail in the
+    stream they return rather than raising, so a streamed result is watched
+    and restarted once when it does. Pulls raise it as a NotFound or an
+    APIError saying access was denied.
+    """
+    _registry_login(cli)
+    try:
+        result = func(*args, **kwargs)
+    except docker.errors.APIError as e:
+        if e.status_code != 401 and not _auth_error(str(e)):
+            raise
+        logging.info('Registry authorization failed, logging in again')
+        _registry_login(cli, force=True)
+        return func(*args, **kwargs)
+    if inspect.isgenerator(result):
+        return _retry_stream(cli, result, func, *args, **kwargs)
+    return result
+
+
+def _list_folder(gc, folder_id, dest):
+    """
+    List a Girder folder tree. Returns the directories that need to be
+    created and the items to download along with their destination directory.
+    """
+    dirs = []
+    items = [(item, dest) for item in gc.listItem(folder_id)]
+    for folder in gc.listFolder(folder_id, parentFolderType='folder'):
+        folder_dir = os.path.join(dest, folder['name'])
+        dirs.append(folder_dir)
+        sub_dirs, sub_items = _list_folder(gc, folder['_id'], folder_dir)
+        dirs += sub_dirs
+        items += sub_items
+    return dirs, items
+
+
+def _item_targets(gc, item, dest):
+    """
+    Return where the files of an item go, following downloadItem: an item
+    holding a single file of the same name becomes a file, any other item a
+    directory. The directory is None in the former case.
+    """
+    files = list(gc.listFile(item['_id']))
+    if len(files) == 1 and files[0]['name'] == item['name']:
+        return None, [(files[0], os.path.join(dest, item['name']))]
+    item_dir = os.path.join(dest, item['name'])
+    return item_dir, [(file, os.path.join(item_dir, file['name']))
+                      for file in files]
+
+
+def _download_file(gc, file_id, path):
+    for attempt in range(RETRIES):
+        try:
+            gc.downloadFile(file_id, path)
+            return
+        except (girder_client.HttpError, requests.exceptions.RequestException,
+                IOError) as e:
+            if attempt == RETRIES - 1:
+                raise
+            logging.warning('Retrying download of %s: %s', path, e)
+            time.sleep(2 ** attempt * 0.1)
+
+
+def _download_folder(gc, folder_id, dest, uid=None, gid=None,
+                     workers=DOWNLOAD_WORKERS):
+    """
+    Recursively download a Girder folder, like downloadFolderRecursive does,
+    setting the ownership of each file and directory as soon as it's written.
+
+    The tree is listed once and the items are downloaded by a pool of
+    threads, each file is retried up to RETRIES times. Returns the number of
+    files and bytes transferred.
+    """
+    def chown(path):
+        if uid is not None:
+            os.lchown(path, uid, gid)
+
+    def download(job):
+        item_dir, targets = _item_targets(gc, *job)
+        if item_dir is not None:
+            _safe_mkdir(item_dir)
+            chown(item_dir)
+        for file, path in targets:
+            _download_file(gc, file['_id'], path)
+            chown(path)
+        return len(targets), sum(file.get('size', 0) for file, _ in targets)
+
+    tic = time.time()
+    dirs, items = _list_folder(gc, folder_id, dest)
+    for path in dirs:
+        _safe_mkdir(path)
+        chown(path)
+
+    report = {'files': 0, 'bytes': 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for files, size in executor.map(download, items):
+            report['files'] += files
+            report['bytes'] += size
+    report['seconds'] = round(time.time() - tic, 2)
+    return report
+
+
+def _chown_dir(path, uid, gid):
+    subdirs = []
+    for entry in os.scandir(path):
+        os.lchown(entry.path, uid, gid)
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+    return subdirs
+
+
+def _chown_tree(path, uid, gid, workers=8):
+    """
+    Change the ownership of a directory tree. Directories are scanned with
+    os.scandir by a pool of threads, one directory per job.
+    """
+    os.lchown(path, uid, gid)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_chown_dir, path, uid, gid)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for subdir in future.result():
+                    pending.add(executor.submit(_chown_dir, subdir, uid, gid))
+
+
+def _is_mounted(path):
+    """Check whether path is a mount point in the host namespace."""
+    # Even without --hostns girderfs mounts land in the host namespace,
+    # mount.c (preloaded in the worker image) setns() before every mount()
+    with open(HOSTDIR + '/proc/1/mounts') as fp:
+        return any(line.split()[1] == path for line in fp)
+
+
+def _find_mount_pid(path):
+    """Return the pid of the girderfs process serving path."""
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/cmdline'.format(pid), 'rb') as fp:
+                args = fp.read().decode('utf-8', 'replace').split('\0')
+        except (IOError, OSError):
+            continue
+        if path in args and any('girderfs' in arg for arg in args[:2]):
+            return int(pid)
+    return None
+
+
+def _girderfs_mount(kind, api_url, api_key, path, folder_id, hostns=False,
+                    timeout=MOUNT_TIMEOUT):
+    """
+    Mount a Girder folder with girderfs and wait until the mount is live.
+
+    The mount is recorded in the node's registry along with the pid of its
+    girderfs process and how long it took to come up.
+    """
+    args = ['girderfs']
+    if hostns:
+        args.append('--hostns')
+    args += ['-c', kind, '--api-url', api_url, '--api-key', api_key,
+             path, str(folder_id)]
+    logging.info("Mounting %s folder %s at %s", kind, folder_id, path)
+
+    tic = time.time()
+    ret = subprocess.call(args)
+    if ret != 0:
+        raise RuntimeError('girderfs exited with {} mounting {}'.format(
+            ret, path))
+    while not _is_mounted(path):
+        if time.time() - tic > timeout:
+            raise RuntimeError('Mount {} not ready after {}s'.format(
+                path, timeout))
+        time.sleep(0.1)
+
+    mount = {
+        'kind': kind,
+        'folderId': str(folder_id),
+        'hostns': hostns,
+        'pid': _find_mount_pid(path),
+        'latency': round(time.time() - tic, 3)
+    }
+    with _mount_registry() as mounts:
+        mounts[path] = mount
+    logging.info("Mounted %s in %.3fs", path, mount['latency'])
+    return mount
+
+
+def _girderfs_unmount(path, lazy=False):
+    """Unmount a girderfs mount and forget about it."""
+    logging.info("Unmounting %s", path)
+    subprocess.call(['umount', '-l', path] if lazy else ['umount', path])
+    with _mount_registry() as mounts:
+        mounts.pop(path, None)
+
+
+def _mount_stats():
+    """Return the memory used by and the latency of each live mount."""
+    with _mount_registry() as mounts:
+        # Forget the mounts that went away without _girderfs_unmount
+        for path in [path for path in mounts if not _is_mounted(path)]:
+            del mounts[path]
+        mounts = dict(mounts)
+    stats = dict()
+    for path, mount in mounts.items():
+        rss = None
+        try:
+            with open('/proc/{}/status'.format(mount['pid'])) as fp:
+                for line in fp:
+                    if line.startswith('VmRSS:'):
+                        rss = int(line.split()[1]) * 1024
+        except (IOError, OSError, TypeError):
+            pass
+        stats[path] = dict(mount, rss=rss)
+    return stats
+
+
+@contextmanager
+def _locked_json(path, default):
+    """
+    Lock a JSON file shared by the workers of this node and yield its
+    content, default if it doesn't exist. Changes are saved on exit.
+    """
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass  # already exists
+    with open(os.path.splitext(path)[0] + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as fp:
+                value = json.load(fp)
+        except (IOError, OSError, ValueError):
+            value = default
+        yield value
+        with open(path, 'w') as fp:
+            json.dump(value, fp)
+
+
+def _mount_registry():
+    """Lock the registry of the girderfs mounts of this node and yield it."""
+    return _locked_json(HOSTDIR + MOUNT_REGISTRY, {})
+
+
+def _shared_mount_refs(folder_id):
+    """
+    Lock the shared mount of a folder on this node and yield its state: the
+    volumes referencing it and the API key it was mounted with. Changes are
+    saved on exit.
+    """
+    return _locked_json(
+        HOSTDIR + os.path.join(SHARED_MOUNT_DIR, str(folder_id)) + '.refs',
+        {'volumes': [], 'apiKey': None})
+
+
+def _api_key_revoked(api_url, api_key):
+    """Return whether Girder refuses an API key, not when it's unreachable."""
+    gc = girder_client.GirderClient(apiUrl=api_url)
+    try:
+        gc.authenticate(apiKey=api_key)
+    except girder_client.HttpError as e:
+        return e.status in (400, 401, 403)
+    except requests.exceptions.RequestException:
+        pass
+    return False
+
+
+def _acquire_shared_mount(folder_id, volume_name, api_url, api_key):
+    """
+    Return the read-only girderfs mount of a folder shared by all the
+    instances on this node, mounting it if volume_name is the first user.
+
+    The mount reads Girder with SHARED_MOUNT_API_KEY when it is set and
+    otherwise with the key of whoever mounted it, so every instance of the
+    tale on the node sees the folder as that user does. When that key gets
+    revoked the mount is replaced with one using api_key; the instances
+    started on the old mount keep it and need a restart.
+    """
+    path = os.path.join(SHARED_MOUNT_DIR, str(folder_id))
+    api_key = SHARED_MOUNT_API_KEY or api_key
+    with _shared_mount_refs(folder_id) as refs:
+        mounted = bool(refs['volumes']) and _is_mounted(path)
+        if mounted and refs['apiKey'] != api_key and \
+                _api_key_revoked(api_url, refs['apiKey']):
+            logging.warning("Key of shared mount %s was revoked, remounting",
+                            path)
+            _girderfs_unmount(path, lazy=True)
+            mounted = False
+        if not mounted:
+            # FUSE is silly and needs to have mirror inside container
+            for directory in (HOSTDIR + path, path):
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+            _girderfs_mount('remote', api_url, api_key, path, folder_id,
+                            hostns=True)
+            refs['apiKey'] = api_key
+        if volume_name not in refs['volumes']:
+            refs['volumes'].append(volume_name)
+        logging.info("Shared mount %s has %d users", path,
+                     len(refs['volumes']))
+    return path
+
+
+def _release_shared_mount(volume_name):
+    """Drop the reference of a volume, unmounting shared mounts left unused."""
+    root = HOSTDIR + SHARED_MOUNT_DIR
+    if not os.path.isdir(root):
+        return
+    for name in os.listdir(root):
+        if not name.endswith('.refs'):
+            continue
+        folder_id = name[:-len('.refs')]
+        with _shared_mount_refs(folder_id) as refs:
+            if volume_name not in refs['volumes']:
+                continue
+            refs['volumes'].remove(volume_name)
+            if not refs['volumes']:
+                _girderfs_unmount(os.path.join(SHARED_MOUNT_DIR, folder_id))
+
+
+def _api_key_id(gc):
+    return (gc.urlBase, _get_user(gc)['_id'])
+
+
 def _get_api_key(gc):
+    """Return the user's tmpnb API key, cached for API_KEY_CACHE_TTL."""
+    key_id = _api_key_id(gc)
+    with _girder_lock:
+        cached = _api_keys.get(key_id)
+    if cached is not None and time.time() < cached[0]:
+        return cached[1]
+
+    # /api_key can't filter by name, page through it until the key shows up
     api_key = None
-    for key in gc.get('/api_key'):
-        if key['name'] == 'tmpnb' and key['active']:
-            api_key = key['key']
+    offset = 0
+    while api_key is None:
+        keys = gc.get('/api_key', parameters={
+            'limit': API_KEY_PAGE, 'offset': offset, 'sort': 'name'})
+        for key in keys:
+            if key['name'] == 'tmpnb' and key['active']:
+                api_key = key['key']
+        if len(keys) < API_KEY_PAGE:
+            break
+        offset += API_KEY_PAGE
 
     if api_key is None:
         api_key = gc.post('/api_key',
                           data={'name': 'tmpnb', 'active': True})['key']
+    with _girder_lock:
+        _api_keys[key_id] = (time.time() + API_KEY_CACHE_TTL, api_key)
     return api_key
 
 
+def _invalidate_api_key(gc):
+    """Forget the cached API key of the user, e.g. when a mount rejected it."""
+    with _girder_lock:
+        _api_keys.pop(_api_key_id(gc), None)
+
+
 def _parse_request_body(data):
-    gc = girder_client.GirderClient(apiUrl=data.get('apiUrl', GIRDER_API_URL))
-    gc.token = data['girder_token']
-    user = gc.get('/user/me')
+    gc = _get_girder_client(data.get('apiUrl', GIRDER_API_URL),
+                            data['girder_token'])
+    user = _get_user(gc)
     if user is None:
         logging.warn("Bad gider token")
         raise ValueError
@@ -102,12 +624,38 @@ def _parse_request_body(data):
     return gc, user, obj
 
 
+def _get_image(gc, image_id):
+    """
+    Return the image document, cached for IMAGE_CACHE_TTL. Past that the
+    document is fetched again and the configs built from it are kept unless
+    it was updated.
+    """
+    with _image_lock:
+        cached = _images.get(image_id)
+    if cached is not None and time.time() < cached[0]:
+        return cached[1]
+    image = gc.get('/image/%s' % image_id)
+    with _image_lock:
+        if cached is not None and cached[1].get('updated') != \
+                image.get('updated'):
+            for key in [key for key in _container_configs
+                        if key[0] == image_id]:
+                del _container_configs[key]
+        _images[image_id] = (time.time() + IMAGE_CACHE_TTL, image)
+    return image
+
+
 def _get_container_config(gc, tale):
     if tale is None:
-        container_config = {}  # settings['container_config']
-    else:
-        image = gc.get('/image/%s' % tale['imageId'])
-        tale_config = image['config'] or {}
+        return {}  # settings['container_config']
+    image = _get_image(gc, tale['imageId'])
+    key = (tale['imageId'], image.get('updated'),
+           hashlib.md5(json.dumps(tale['config'], sort_keys=True)
+                       .encode('utf8')).hexdigest())
+    with _image_lock:
+        container_config = _container_configs.get(key)
+    if container_config is None:
+        tale_config = dict(image['config'] or {})
         if tale['config']:
             tale_config.update(tale['config'])
         container_config = ContainerConfig(
@@ -121,10 +669,116 @@ def _get_container_config(gc, tale):
             target_mount=tale_config.get('targetMount'),
             url_path=tale_config.get('urlPath')
         )
+        with _image_lock:
+            _container_configs[key] = container_config
+            while len(_container_configs) > CONTAINER_CONFIG_ENTRIES:
+                _container_configs.popitem(last=False)
     return container_config
 
 
-def _launch_container(volumeName, nodeId, container_config):
+def _parse_size(value):
+    """Return a size such as 2g, 512m or 1073741824 in bytes."""
+    if value is None or isinstance(value, int):
+        return value
+    match = re.match(r'^\s*([\d.]+)\s*([kmgt]?)b?\s*$', str(value).lower())
+    if match is None:
+        raise ValueError('Invalid size: {}'.format(value))
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' kmgt'.index(unit or ' '))
+
+
+def _resource_spec(container_config):
+    """
+    Return the limits and reservations of an instance in the units of the
+    swarm API: bytes and nano cpus, cpu shares of 1024 being one cpu.
+    cpuShares is a relative weight, so it only sets a reservation.
+    """
+    mem = _parse_size(container_config.mem_limit)
+    spec = {}
+    if mem:
+        spec.update(mem_limit=mem,
+                    mem_reservation=int(mem * RESERVATION_RATIO))
+    if container_config.cpu_shares:
+        spec.update(cpu_reservation=int(
+            float(container_config.cpu_shares) / 1024 * 1e9 *
+            RESERVATION_RATIO))
+    return spec
+
+
+def _host_meminfo():
+    """Return the fields of the host's /proc/meminfo in bytes."""
+    info = dict()
+    with open(HOSTDIR + '/proc/meminfo') as fp:
+        for line in fp:
+            key, value = line.split(':', 1)
+            info[key] = int(value.split()[0]) * 1024
+    return info
+
+
+def _node_usage(cli, nodeId):
+    """
+    Return the memory and nano cpus of a node and the part of them reserved
+    by the instances running on it.
+
+    Instances are found by their node constraint, which also matches the
+    ones started before they were labeled. Those have no reservations, so
+    on the local node the memory in use is counted when it's larger.
+    """
+    resources = cli.nodes.get(nodeId).attrs['Description']['Resources']
+    constraint = 'node.id == {}'.format(nodeId)
+    reserved = {'mem': 0, 'cpu': 0}
+    for service in cli.services.list():
+        template = service.attrs['Spec']['TaskTemplate']
+        if constraint not in template.get('Placement', {}).get(
+                'Constraints', []):
+            continue
+        reservations = template.get('Resources', {}).get('Reservations', {})
+        reserved['mem'] += reservations.get('MemoryBytes', 0)
+        reserved['cpu'] += reservations.get('NanoCPUs', 0)
+    if nodeId == cli.info()['Swarm']['NodeID']:
+        meminfo = _host_meminfo()
+        used = meminfo['MemTotal'] - meminfo.get('MemAvailable',
+                                                 meminfo['MemFree'])
+        reserved['mem'] = max(reserved['mem'], used)
+    return {
+        'memCapacity': int(resources['MemoryBytes'] * OVERCOMMIT_RATIO),
+        'cpuCapacity': int(resources['NanoCPUs'] * OVERCOMMIT_RATIO),
+        'memReserved': reserved['mem'],
+        'cpuReserved': reserved['cpu']
+    }
+
+
+def _fits(usage, spec):
+    """Tell if a node with the given usage has room for a resource spec."""
+    return \
+        usage['memReserved'] + spec.get('mem_reservation', 0) <= \
+        usage['memCapacity'] and \
+        usage['cpuReserved'] + spec.get('cpu_reservation', 0) <= \
+        usage['cpuCapacity']
+
+
+@contextmanager
+def _node_admission(cli, nodeId, spec):
+    """
+    Hold the launch lock of this node while a service is created, raising
+    RuntimeError if its reservations would overcommit the node.
+    """
+    path = HOSTDIR + LAUNCH_LOCK
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass  # already exists
+    with open(path, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        usage = _node_usage(cli, nodeId)
+        if not _fits(usage, spec):
+            raise RuntimeError(
+                'Node {} has no room for the instance: {} requested, {} '
+                'in use'.format(nodeId, spec, usage))
+        yield usage
+
+
+def _launch_container(volumeName, nodeId, container_config, data_mount=None):
 
     token = uuid.uuid4().hex
     # command
@@ -144,9 +798,7 @@ def _launch_container(volumeName, nodeId, container_config):
 
     logging.info('config = ' + str(container_config))
     logging.info('command = ' + str(rendered_command))
-    cli = docker.from_env(version='1.28')
-    cli.login(username=REGISTRY_USER, password=REGISTRY_PASS,
-              registry=REGISTRY_URL)
+    cli = _get_docker_client()
     # Fails with: 'starting container failed: error setting
     #              label on mount source ...: read-only file system'
     # mounts = [
@@ -160,44 +812,121 @@ def _launch_container(volumeName, nodeId, container_config):
     for path in ('data', 'home'):
         source = os.path.join(source_mount, path)
         target = os.path.join(container_config.target_mount, path)
+        read_only = False
+        if path == 'data' and data_mount:
+            # Shared by all the instances of the tale on the node
+            source = data_mount
+            read_only = True
         mounts.append(
-            docker.types.Mount(type='bind', source=source, target=target)
+            docker.types.Mount(type='bind', source=source, target=target,
+                               read_only=read_only)
         )
     host = 'tmp-{}'.format(new_user(12).lower())
 
     # https://github.com/containous/traefik/issues/2582#issuecomment-354107053
     endpoint_spec = docker.types.EndpointSpec(mode="vip")
 
-    service = cli.services.create(
-        container_config.image,
-        command=rendered_command,
-        labels={
-            'traefik.port': str(container_config.container_port),
-            'traefik.enable': 'true',
-            'traefik.frontend.rule': 'Host:{}.{}'.format(host, DOMAIN),
-            'traefik.docker.network': TRAEFIK_NETWORK,
-            'traefik.frontend.passHostHeader': 'true',
-            'traefik.frontend.entryPoints': TRAEFIK_ENTRYPOINT
-        },
-        env=container_config.environment,
-        mode=docker.types.ServiceMode('replicated', replicas=1),
-        networks=[TRAEFIK_NETWORK],
-        name=host,
-        mounts=mounts,
-        endpoint_spec=endpoint_spec,
-        constraints=['node.id == {}'.format(nodeId)]
-    )
-
-    # resources=docker.types.Resources(mem_limit='2g'),
-    # FIXME for some reason causes 500
-
-    # Wait for the server to launch within the container before adding it
-    # to the pool or serving it to a user.
-    # _wait_for_server(host_ip, host_port, path) # FIXME
+    # The swarm API wants bytes, a size such as '2g' makes it fail with 500
+    spec = _resource_spec(container_config)
+    with _node_admission(cli, nodeId, spec):
+        service = _with_registry_auth(
+            cli, cli.services.create,
+            container_config.image,
+            command=rendered_command,
+            labels={
+                'traefik.port': str(container_config.container_port),
+                'traefik.enable': 'true',
+                'traefik.frontend.rule': 'Host:{}.{}'.format(host, DOMAIN),
+                'traefik.docker.network': TRAEFIK_NETWORK,
+                'traefik.frontend.passHostHeader': 'true',
+                'traefik.frontend.entryPoints': TRAEFIK_ENTRYPOINT,
+                NODE_LABEL: nodeId
+            },
+            env=container_config.environment,
+            mode=docker.types.ServiceMode('replicated', replicas=1),
+            networks=[TRAEFIK_NETWORK],
+            name=host,
+            mounts=mounts,
+            endpoint_spec=endpoint_spec,
+            constraints=['node.id == {}'.format(nodeId)],
+            resources=docker.types.Resources(**spec) if spec else None
+        )
 
+    # The caller waits for the server with _wait_for_service and
+    # _wait_for_server before handing the instance to the user.
     return service, rendered_url_path
 
 
+def _service_state(service):
+    try:
+        return service.tasks()[0]['Status']['State']
+    except IndexError:
+        return None
+
+
+def _wait_for_service(cli, service, nodeId, since, deadline):
+    """
+    Wait until the task of a service is running.
+
+    Containers started or dying on this node are detected from the docker
+    event stream, services placed on other nodes are polled. The stream is
+    read in short windows with the task state checked in between, since a
+    task rejected before it gets a container emits no event.
+    """
+    if _service_state(service) == 'running':
+        return True
+
+    if nodeId == cli.info()['Swarm']['NodeID']:
+        filters = {
+            'type': 'container',
+            'event': ['start', 'die'],
+            'label': 'com.docker.swarm.service.id={}'.format(service.id)
+        }
+        window_start = since
+        while time.time() < deadline:
+            window_end = min(deadline, time.time() + EVENT_WINDOW)
+            event = next(iter(cli.events(
+                since=int(window_start), until=int(window_end) + 1,
+                filters=filters, decode=True)), None)
+            if event is not None:
+                logging.debug('Service %s container %s: %s', service.name,
+                              event['id'], event.get('status'))
+                break
+            if _service_state(service) in ('running', 'failed', 'rejected'):
+                break
+            window_start = window_end
+
+    while time.time() < deadline:
+        state = _service_state(service)
+        if state == 'running':
+            return True
+        if state in ('failed', 'rejected'):
+            logging.error('Service %s %s', service.name, state)
+            return False
+        time.sleep(0.2)
+    return _service_state(service) == 'running'
+
+
+def _wait_for_server(url, deadline):
+    """
+    Wait until the server behind the proxy answers at url.
+
+    Traefik answers 404 until it picks up the frontend and 502-504 until the
+    backend accepts connections, any other response comes from the server.
+    """
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        try:
+            r = requests.get(url, timeout=min(remaining, 5.0))
+            if r.status_code not in (404, 502, 503, 504):
+                return True
+        except requests.exceptions.RequestException as e:
+            logging.debug('Waiting for %s: %s', url, e)
+        time.sleep(0.2)
+
+
 def get_file_item(item_id, gc):
     """
     Gets the file out of an item.
@@ -215,6 +944,57 @@ def get_file_item(item_id, gc):
         return None
 
 
+class ItemMetadataCache(object):
+    """
+    Holds the Girder metadata of the items in a job, so that each item, its
+    file and its path are only requested once no matter how many steps of the
+    job need them. Missing entries are fetched on demand; `prefetch` fetches
+    a batch of items in parallel up front.
+    """
+
+    def __init__(self, gc, workers=8):
+        self.gc = gc
+        self.workers = workers
+        self._items = dict()
+        self._files = dict()
+        self._paths = dict()
+        self._lock = threading.Lock()
+
+    def _fetch(self, cache, item_id, getter):
+        with self._lock:
+            if item_id in cache:
+                return cache[item_id]
+        value = getter(item_id)
+        with self._lock:
+            cache[item_id] = value
+        return value
+
+    def get_item(self, item_id):
+        """Return the item document."""
+        return self._fetch(self._items, item_id, self.gc.getItem)
+
+    def get_file(self, item_id):
+        """Return the first file inside the item, or None."""
+        return self._fetch(self._files, item_id,
+                           lambda i: get_file_item(i, self.gc))
+
+    def get_path(self, item_id):
+        """Return the path of the item in Girder."""
+        return self._fetch(
+            self._paths, item_id,
+            lambda i: self.gc.get('resource/{}/path?type=item'.format(i)))
+
+    def prefetch(self, item_ids):
+        """Fetch the item, file and path of each item in parallel."""
+        def fetch(item_id):
+            self.get_item(item_id)
+            self.get_file(item_id)
+            self.get_path(item_id)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(fetch, item_ids))
+
+
 def is_dataone_url(url):
     """
     Checks if a url has dataone in it
@@ -299,7 +1079,7 @@ def check_pid(pid):
         return pid
 
 
-def get_remote_url(item_id, gc):
+def get_remote_url(item_id, gc, cache=None):
     """
     Checks if a file has a link url and returns the url if it does. This is less
      restrictive than thecget_dataone_url in that we aren't restricting the link
@@ -307,11 +1087,15 @@ def get_remote_url(item_id, gc):
 
     :param item_id: The id of the item
     :param gc: The girder client
+    :param cache: The metadata cache of the job
+    :type cache: ItemMetadataCache
     :return: The url that points to the object
     :rtype: str or None
     """
 
-    file = get_file_item(item_id, gc)
+    if cache is None:
+        cache = ItemMetadataCache(gc)
+    file = cache.get_file(item_id)
     if file is None:
         file_error = 'Failed to find the file with ID {}'.format(item_id)
         logging.warning(file_error)
@@ -433,6 +1217,71 @@ def get_file_md5(file_object, gc):
     return md5
 
 
+class IteratorReader(object):
+    """
+    A read-only file object over an iterator of byte chunks, such as the one
+    returned by `GirderClient.downloadFileAsIterator`. Providing the length
+    allows the content to be streamed as an upload body.
+    """
+
+    def __init__(self, chunks, length=None):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self.len = length
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def download_file_md5(file_id, file, gc):
+    """
+    Streams a file from the Girder filesystem into an open file handle and
+    computes its md5 along the way, so that the content is only read once.
+    The file handle is rewound before returning.
+
+    :param file_id: The id of the file that will be downloaded
+    :param file: An open file handle that the file is written to
+    :param gc: The girder client
+    :type file_id: str
+    :return: Returns an updated md5 object
+    :rtype: md5
+    """
+    md5, _ = copy_md5(gc.downloadFileAsIterator(file_id), file)
+    file.seek(0)
+    return md5
+
+
+def copy_md5(chunks, file):
+    """
+    Writes an iterable of byte chunks into an open file handle while computing
+    the md5 of the content. The content is never held in memory as a whole.
+
+    :param chunks: An iterable yielding bytes
+    :param file: An open file handle that the chunks are written to
+    :return: The md5 object and the number of bytes written
+    :rtype: tuple
+    """
+    md5 = hashlib.md5()
+    size = 0
+    for chunk in chunks:
+        md5.update(chunk)
+        file.write(chunk)
+        size += len(chunk)
+    file.flush()
+    return md5, size
+
+
 def compute_md5(file):
     """
     Takes an file handle and computes the md5 of it. This uses duck typing
@@ -452,7 +1301,7 @@ def compute_md5(file):
     return md5
 
 
-def filter_items(item_ids, gc):
+def filter_items(item_ids, gc, cache=None):
     """
     Take a list of item ids and determine whether it:
        1. Exists on the local file system
@@ -460,7 +1309,9 @@ def filter_items(item_ids, gc):
        3. Is linked to a remote location other than DataONE
     :param item_ids: A list of items to be processed
     :param gc: The girder client
+    :param cache: The metadata cache of the job
     :type item_ids: list
+    :type cache: ItemMetadataCache
     :return: A dictionary of lists for each file location
     For example,
      {'dataone': ['uuid:123456', 'doi.10x501'],
@@ -478,9 +1329,12 @@ def filter_items(item_ids, gc):
     # Holds item_ids for local files
     local_items = list()
 
+    if cache is None:
+        cache = ItemMetadataCache(gc)
+
     for item_id in item_ids:
         # Check if it points do a dataone objbect
-        url = get_remote_url(item_id, gc)
+        url = get_remote_url(item_id, gc, cache)
         if url is not None:
             if is_dataone_url(url):
                 dataone_objects.append(item_id)
@@ -497,7 +1351,7 @@ def filter_items(item_ids, gc):
         # If the file wasn't linked to a remote location, then it must exist locally. This
         # is a list of girder.models.File objects
         logging.debug('Adding local object')
-        local_objects.append(get_file_item(item_id, gc))
+        local_objects.append(cache.get_file(item_id))
         local_items.append(item_id)
 
     return {'dataone': dataone_objects,
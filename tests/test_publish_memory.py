@@ -0,0 +1,72 @@
+"""
+Peak memory of uploading a large local file to DataONE.
+
+A fake file of PUBLISH_TEST_SIZE bytes (3 GiB by default) is streamed from a
+stub Girder client through create_upload_object_metadata into a stub member
+node client, once with a cold checksum cache (the file is spooled to disk) and
+once with a warm one (the file goes straight from Girder to DataONE). The peak
+RSS of the process may not grow by more than RSS_BOUND on either path.
+"""
+import os
+import resource
+
+import pytest
+
+pytest.importorskip('d1_client')
+
+from gwvolman import publish  # noqa: E402
+from gwvolman.cache import ChecksumCache  # noqa: E402
+
+FAKE_SIZE = int(os.environ.get('PUBLISH_TEST_SIZE', 3 * 1024 ** 3))
+CHUNK = b'\0' * 1024 ** 2
+RSS_BOUND = 256 * 1024 ** 2
+
+
+class FakeGirder(object):
+    def downloadFileAsIterator(self, file_id):
+        for _ in range(FAKE_SIZE // len(CHUNK)):
+            yield CHUNK
+        yield CHUNK[:FAKE_SIZE % len(CHUNK)]
+
+
+class FakeMemberNode(object):
+    def __init__(self):
+        self.received = {}
+
+    def create(self, pid, obj, system_metadata):
+        size = 0
+        for chunk in iter(lambda: obj.read(len(CHUNK)), b''):
+            size += len(chunk)
+        self.received[pid] = size
+
+
+def _peak_rss():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def test_large_upload_memory(tmp_path, monkeypatch):
+    monkeypatch.setattr(publish.tempfile, 'tempdir', str(tmp_path))
+    monkeypatch.setattr(publish, 'MD5_CACHE',
+                        ChecksumCache(str(tmp_path / 'md5.sqlite')))
+    file_object = {
+        '_id': 'fake',
+        'name': 'fake.bin',
+        'mimeType': 'application/octet-stream',
+        'size': FAKE_SIZE,
+        'updated': '2018-01-01T00:00:00'
+    }
+    client = FakeMemberNode()
+    gc = FakeGirder()
+
+    for expected_hits in (0, 1):
+        before = _peak_rss()
+        pid = publish.create_upload_object_metadata(
+            client, file_object, 'http://orcid.org/0000-0000-0000-0000', gc)
+        growth = _peak_rss() - before
+
+        assert pid is not None
+        assert client.received[pid] == FAKE_SIZE
+        assert publish.MD5_CACHE.hits == expected_hits
+        assert growth < RSS_BOUND, \
+            'peak RSS grew by {} MiB'.format(growth // 1024 ** 2)